@@ -4,16 +4,14 @@ an artificial intelligence-based Side-specific Extra-Prostatic Extension Risk As
 (SEPERA) for patients undergoing radical prostatectomy: a retrospective cohort study.
 """
 
-# Import packages and libraries
-import pandas as pd
-import numpy as np
-import PIL.Image
+# Import packages and libraries. NumPy, pandas, PIL and the model code are only imported on the first submit (or by the
+# prewarm thread), so that the page renders without waiting for them.
 import streamlit as st
-import joblib
-from pathlib import Path
-from PIL import ImageFont, ImageDraw, ImageOps
-from google_drive_downloader import GoogleDriveDownloader as gdd
 from persist import persist, load_widget_state
+import metrics
+import resources
+import session
+from choices import G_CHOICES
 
 def main():
     if "page" not in st.session_state:
@@ -41,43 +39,17 @@ def page_sepera():
         * Probability of side-specific extraprostatic extension for the left and right prostatic lobe
         * Number of patients with similar characteristics from our database that had side-specific extraprostatic extension
         * Prostate diagram showing location and severity of disease
+        * Contribution of each feature to the probability of each lobe
     """
     )
 
-    # Specify font size for annotated prostate diagram
-    font = ImageFont.truetype('Images/Font.ttf', 80)
+    # Google Drive locations of saved items, used when they are not available locally
+    try:
+        drive_ids = {'SEPERA.pkl': st.secrets['SEPERA'], 'data.pkl': st.secrets['Data']}
+    except (FileNotFoundError, KeyError):
+        drive_ids = {}
 
-    # Load saved items from Google Drive
-    Model_location = st.secrets['SEPERA']
-    Data_location = st.secrets['Data']
-
-    @st.cache(allow_output_mutation=True)
-    def load_items():
-        save_dest = Path('model')
-        save_dest.mkdir(exist_ok=True)
-        model_checkpoint = Path('model/SEPERA.pkl')
-        data_checkpoint = Path('model/data.pkl')
-
-        # download from Google Drive if model or features are not present
-        if not model_checkpoint.exists():
-            with st.spinner("Downloading ... this may take awhile! \n Don't stop it!"):
-                gdd.download_file_from_google_drive(Model_location, model_checkpoint)
-        if not data_checkpoint.exists():
-            with st.spinner("Downloading ... this may take awhile! \n Don't stop it!"):
-                gdd.download_file_from_google_drive(Data_location, data_checkpoint)
-
-        model = joblib.load(model_checkpoint)
-        data = joblib.load(data_checkpoint)
-        return model, data
-
-    model, data = load_items()
-
-    # Load blank prostate as image objects from GitHub repository
-    def load_images():
-        image = PIL.Image.open('Images/Prostate diagram.png')
-        return image
-
-    image = load_images()
+    resources.configure(drive_ids=drive_ids)
 
     # Define choices and labels for feature inputs
     CHOICES = {0: 'No', 1: 'Yes', -1: 'Unknown'}
@@ -85,14 +57,6 @@ def page_sepera():
     def format_func_yn(option):
         return CHOICES[option]
 
-    G_CHOICES = {0: 'Normal',
-                 1: 'ISUP Grade 1',
-                 2: 'ISUP Grade 2',
-                 3: 'ISUP Grade 3',
-                 4: 'ISUP Grade 4',
-                 5: 'ISUP Grade 5',
-                 -1: 'Unknown'}
-
     def format_func_gleason(option):
         return G_CHOICES[option]
 
@@ -143,283 +107,214 @@ def page_sepera():
         submitted = st.form_submit_button(label='SUBMIT')
 
         if submitted:
-            ### CHECK FOR ERRORS ###
-            if (base_findings == 0 and base_p_inv != 0) or (mid_findings == 0 and mid_p_inv != 0) or (apex_findings == 0 and apex_p_inv != 0) or (base_findings_r == 0 and base_p_inv_r != 0) or (mid_findings_r == 0 and mid_p_inv_r != 0) or (apex_findings_r == 0 and apex_p_inv_r != 0):
-                st.warning("Error: Please ensure % core involvement is set to 0 if the biopsy cores at that site are "
-                           "Normal.")
+            import numpy as np
+            from features import validation_errors
 
-            elif (base_findings == -1 and base_p_inv != -1) or (mid_findings == -1 and mid_p_inv != -1) or (apex_findings == -1 and apex_p_inv != -1) or (base_findings_r == -1 and base_p_inv_r != -1) or (mid_findings_r == -1 and mid_p_inv_r != -1) or (apex_findings_r == -1 and apex_p_inv_r != -1):
-                st.warning("Error: Please ensure % core involvement is set to -1 if the biopsy cores at that site are "
-                           "Unknown.")
+            # Group raw inputs into a single row, in the order expected by the feature builder
+            inputs = np.array([[age, psa, vol, p_high, perineural_inv,
+                                base_findings, base_p_inv, mid_findings, mid_p_inv, apex_findings, apex_p_inv,
+                                pos_core, taken_core,
+                                base_findings_r, base_p_inv_r, mid_findings_r, mid_p_inv_r, apex_findings_r,
+                                apex_p_inv_r, pos_core_r, taken_core_r]], dtype=float)
 
-            elif (pos_core > taken_core) or (pos_core_r > taken_core_r):
-                st.warning("Error: The number of positive cores should be equal or less than the number of cores taken."
-                           "")
+            metrics.increment('submits_total')
+
+            ### CHECK FOR ERRORS ###
+            with metrics.span('validate'):
+                error = validation_errors(inputs)[0]
+            if error is not None:
+                metrics.increment('validation_rejections_total')
+                st.warning(error)
 
             else:
-                ### LEFT DATA STORAGE ###
-                # Group site findings into a list
-                gleason_t = [base_findings, mid_findings, apex_findings]
-
-                # Group % core involvements at each site into a list
-                p_inv_t = [base_p_inv, mid_p_inv, apex_p_inv]
-
-                # Combine site findings and % core involvements into a pandas DataFrame and sort by descending Gleason
-                # then descending % core involvement
-                g_p_inv = pd.DataFrame({'Gleason': gleason_t, '% core involvement': p_inv_t})
-                sort_g_p_inv = g_p_inv.sort_values(by=['Gleason', '% core involvement'], ascending=False)
-
-                # Store a dictionary into a variable
-                pt_data = {'Age at Biopsy': age,
-                           'Worst Gleason Grade Group': sort_g_p_inv['Gleason'].max(),
-                           'PSA density': psa / vol,
-                           'Perineural invasion': perineural_inv,
-                           '% positive cores': (pos_core / taken_core) * 100,
-                           '% Gleason pattern 4/5': p_high,
-                           'Max % core involvement': sort_g_p_inv['% core involvement'].max(),
-                           'Base finding': base_findings,
-                           'Base % core involvement': base_p_inv,
-                           'Mid % core involvement': mid_p_inv,
-                           'Apex % core involvement': apex_p_inv
-                           }
-
-                pt_features = pd.DataFrame(pt_data, index=[0])
-
-                ### RIGHT DATA STORAGE ###
-                # Group site findings into a list
-                gleason_t_r = [base_findings_r, mid_findings_r, apex_findings_r]
-
-                # Group % core involvements at each site into a list
-                p_inv_t_r = [base_p_inv_r, mid_p_inv_r, apex_p_inv_r]
-
-                # Combine site findings and % core involvements into a pandas DataFrame and sort by descending Gleason
-                # then descending % core involvement
-                g_p_inv_r = pd.DataFrame({'Gleason': gleason_t_r, '% core involvement': p_inv_t_r})
-                sort_g_p_inv_r = g_p_inv_r.sort_values(by=['Gleason', '% core involvement'], ascending=False)
-
-                # Store a dictionary into a variable
-                pt_data_r = {'Age at Biopsy': age,
-                             'Worst Gleason Grade Group': sort_g_p_inv_r['Gleason'].max(),
-                             'PSA density': psa / vol,
-                             'Perineural invasion': perineural_inv,
-                             '% positive cores': (pos_core_r / taken_core_r) * 100,
-                             '% Gleason pattern 4/5': p_high,
-                             'Max % core involvement': sort_g_p_inv_r['% core involvement'].max(),
-                             'Base finding': base_findings_r,
-                             'Base % core involvement': base_p_inv_r,
-                             'Mid % core involvement': mid_p_inv_r,
-                             'Apex % core involvement': apex_p_inv_r
-                             }
-
-                pt_features_r = pd.DataFrame(pt_data_r, index=[0])
-
-                ### ANNOTATED PROSTATE DIAGRAM ###
-                # Create text to overlay on annotated prostate diagram, auto-updates based on user inputted values
-                if base_findings <= 0 or base_p_inv <= 0:
-                    base_L = str(G_CHOICES[base_findings]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    base_L = str(G_CHOICES[base_findings]) + '\n' \
-                         + '% core involvement: ' + str(base_p_inv)
-                if mid_findings <= 0 or mid_p_inv <= 0:
-                    mid_L = str(G_CHOICES[mid_findings]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    mid_L = str(G_CHOICES[mid_findings]) + '\n' \
-                         + '% core involvement: ' + str(mid_p_inv)
-                if apex_findings <= 0 or apex_p_inv <= 0:
-                    apex_L = str(G_CHOICES[apex_findings]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    apex_L = str(G_CHOICES[apex_findings]) + '\n' \
-                         + '% core involvement: ' + str(apex_p_inv)
-
-                if base_findings_r <= 0 or base_p_inv_r <= 0:
-                    base_R = str(G_CHOICES[base_findings_r]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    base_R = str(G_CHOICES[base_findings_r]) + '\n' \
-                         + '% core involvement: ' + str(base_p_inv_r)
-                if mid_findings_r <= 0 or mid_p_inv_r <= 0:
-                    mid_R = str(G_CHOICES[mid_findings_r]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    mid_R = str(G_CHOICES[mid_findings_r]) + '\n' \
-                         + '% core involvement: ' + str(mid_p_inv_r)
-                if apex_findings_r <= 0 or apex_p_inv_r <= 0:
-                    apex_R = str(G_CHOICES[apex_findings_r]) + '\n' \
-                         + '% core involvement: n/a'
-                else:
-                    apex_R = str(G_CHOICES[apex_findings_r]) + '\n' \
-                         + '% core involvement: ' + str(apex_p_inv_r)
-
-                # Set conditions to show colour coded site images based on Gleason Grade Group for each site
-                draw = ImageDraw.Draw(image)
-                if base_findings == 1:
-                    image_bl_G1 = PIL.Image.open('Images/Base 1.png').convert('RGBA')
-                    image.paste(image_bl_G1, (495, 1615), mask=image_bl_G1)
-                if base_findings == 2:
-                    image_bl_G2 = PIL.Image.open('Images/Base 2.png').convert('RGBA')
-                    image.paste(image_bl_G2, (495, 1615), mask=image_bl_G2)
-                if base_findings == 3:
-                    image_bl_G3 = PIL.Image.open('Images/Base 3.png').convert('RGBA')
-                    image.paste(image_bl_G3, (495, 1615), mask=image_bl_G3)
-                if base_findings == 4:
-                    image_bl_G4 = PIL.Image.open('Images/Base 4.png').convert('RGBA')
-                    image.paste(image_bl_G4, (495, 1615), mask=image_bl_G4)
-                if base_findings == 5:
-                    image_bl_G5 = PIL.Image.open('Images/Base 5.png').convert('RGBA')
-                    image.paste(image_bl_G5, (495, 1615), mask=image_bl_G5)
-
-                if mid_findings == 1:
-                    image_ml_G1 = PIL.Image.open('Images/Mid 1.png').convert('RGBA')
-                    image.paste(image_ml_G1, (495, 965), mask=image_ml_G1)  # 606
-                if mid_findings == 2:
-                    image_ml_G2 = PIL.Image.open('Images/Mid 2.png').convert('RGBA')
-                    image.paste(image_ml_G2, (495, 965), mask=image_ml_G2)
-                if mid_findings == 3:
-                    image_ml_G3 = PIL.Image.open('Images/Mid 3.png').convert('RGBA')
-                    image.paste(image_ml_G3, (495, 965), mask=image_ml_G3)
-                if mid_findings == 4:
-                    image_ml_G4 = PIL.Image.open('Images/Mid 4.png').convert('RGBA')
-                    image.paste(image_ml_G4, (495, 965), mask=image_ml_G4)
-                if mid_findings == 5:
-                    image_ml_G5 = PIL.Image.open('Images/Mid 5.png').convert('RGBA')
-                    image.paste(image_ml_G5, (495, 965), mask=image_ml_G5)
-
-                if apex_findings == 1:
-                    image_al_G1 = PIL.Image.open('Images/Apex 1.png').convert('RGBA')
-                    image.paste(image_al_G1, (495, 187), mask=image_al_G1)
-                if apex_findings == 2:
-                    image_al_G2 = PIL.Image.open('Images/Apex 2.png').convert('RGBA')
-                    image.paste(image_al_G2, (495, 187), mask=image_al_G2)
-                if apex_findings == 3:
-                    image_al_G3 = PIL.Image.open('Images/Apex 3.png').convert('RGBA')
-                    image.paste(image_al_G3, (495, 187), mask=image_al_G3)
-                if apex_findings == 4:
-                    image_al_G4 = PIL.Image.open('Images/Apex 4.png').convert('RGBA')
-                    image.paste(image_al_G4, (495, 187), mask=image_al_G4)
-                if apex_findings == 5:
-                    image_al_G5 = PIL.Image.open('Images/Apex 5.png').convert('RGBA')
-                    image.paste(image_al_G5, (495, 187), mask=image_al_G5)
-
-                if base_findings_r == 1:
-                    image_br_G1 = PIL.ImageOps.mirror(PIL.Image.open('Images/Base 1.png')).convert('RGBA')
-                    image.paste(image_br_G1, (1665, 1615), mask=image_br_G1)
-                if base_findings_r == 2:
-                    image_br_G2 = PIL.ImageOps.mirror(PIL.Image.open('Images/Base 2.png')).convert('RGBA')
-                    image.paste(image_br_G2, (1665, 1615), mask=image_br_G2)
-                if base_findings_r == 3:
-                    image_br_G3 = PIL.ImageOps.mirror(PIL.Image.open('Images/Base 3.png')).convert('RGBA')
-                    image.paste(image_br_G3, (1665, 1615), mask=image_br_G3)
-                if base_findings_r == 4:
-                    image_br_G4 = PIL.ImageOps.mirror(PIL.Image.open('Images/Base 4.png')).convert('RGBA')
-                    image.paste(image_br_G4, (1665, 1615), mask=image_br_G4)
-                if base_findings_r == 5:
-                    image_br_G5 = PIL.ImageOps.mirror(PIL.Image.open('Images/Base 5.png')).convert('RGBA')
-                    image.paste(image_br_G5, (1665, 1615), mask=image_br_G5)
-
-                if mid_findings_r == 1:
-                    image_mr_G1 = PIL.Image.open('Images/Mid 1.png').convert('RGBA')
-                    image.paste(image_mr_G1, (1665, 965), mask=image_mr_G1)
-                if mid_findings_r == 2:
-                    image_mr_G2 = PIL.Image.open('Images/Mid 2.png').convert('RGBA')
-                    image.paste(image_mr_G2, (1665, 965), mask=image_mr_G2)
-                if mid_findings_r == 3:
-                    image_mr_G3 = PIL.Image.open('Images/Mid 3.png').convert('RGBA')
-                    image.paste(image_mr_G3, (1665, 965), mask=image_mr_G3)
-                if mid_findings_r == 4:
-                    image_mr_G4 = PIL.Image.open('Images/Mid 4.png').convert('RGBA')
-                    image.paste(image_mr_G4, (1665, 965), mask=image_mr_G4)
-                if mid_findings_r == 5:
-                    image_mr_G5 = PIL.Image.open('Images/Mid 5.png').convert('RGBA')
-                    image.paste(image_mr_G5, (1665, 965), mask=image_mr_G5)
-
-                if apex_findings_r == 1:
-                    image_ar_G1 = PIL.ImageOps.mirror(PIL.Image.open('Images/Apex 1.png')).convert('RGBA')
-                    image.paste(image_ar_G1, (1665, 187), mask=image_ar_G1)
-                if apex_findings_r == 2:
-                    image_ar_G2 = PIL.ImageOps.mirror(PIL.Image.open('Images/Apex 2.png')).convert('RGBA')
-                    image.paste(image_ar_G2, (1665, 187), mask=image_ar_G2)
-                if apex_findings_r == 3:
-                    image_ar_G3 = PIL.ImageOps.mirror(PIL.Image.open('Images/Apex 3.png')).convert('RGBA')
-                    image.paste(image_ar_G3, (1665, 187), mask=image_ar_G3)
-                if apex_findings_r == 4:
-                    image_ar_G4 = PIL.ImageOps.mirror(PIL.Image.open('Images/Apex 4.png')).convert('RGBA')
-                    image.paste(image_ar_G4, (1665, 187), mask=image_ar_G4)
-                if apex_findings_r == 5:
-                    image_ar_G5 = PIL.ImageOps.mirror(PIL.Image.open('Images/Apex 5.png')).convert('RGBA')
-                    image.paste(image_ar_G5, (1665, 187), mask=image_ar_G5)
-
-                # Overlay text showing Gleason Grade Group, % positive cores, and % core involvement for each site
-                draw.text((655, 1920), base_L, fill="black", font=font, align="center")
-                draw.text((655, 1190), mid_L, fill="black", font=font, align="center")
-                draw.text((735, 545), apex_L, fill="black", font=font, align="center")
-                draw.text((1850, 1920), base_R, fill="black", font=font, align="center")
-                draw.text((1850, 1190), mid_R, fill="black", font=font, align="center")
-                draw.text((1770, 545), apex_R, fill="black", font=font, align="center")
-
-                col4, col5 = st.columns([1, 2])
-                left_prob = str((model.predict_proba(pt_features)[:, 1] * 100).round())[1:-2]
-                right_prob = str((model.predict_proba(pt_features_r)[:, 1] * 100).round())[1:-2]
+                from audit import make_record
+                from features import INPUTS, build_features
+                from inference import predict
+                from intervals import wilson
+
+                # Load the model and reference cohort on the first submit rather than on page load. They are shared by
+                # every session of this process.
+                with metrics.span('load_resources'):
+                    if not (resources.loaded('model') and resources.loaded('cohort')) and resources.missing():
+                        with st.spinner("Downloading ... this may take awhile! \n Don't stop it!"):
+                            resources.get('model')
+                            resources.get('cohort')
+                    model = resources.get('model')
+                    index = resources.get('similar_index')
+
+                ### LEFT AND RIGHT DATA STORAGE ###
+                # Build the features of both lobes at once: row 0 is the left lobe and row 1 the right lobe
+                with metrics.span('features'):
+                    features = build_features(inputs)
+                pt_features = features[:1]
+                pt_features_r = features[1:]
+
+                # Score both lobes with a single (cached) model call
+                with metrics.span('predict'):
+                    prob, prob_r = predict(model, features)
 
                 ### SIMILAR CASE FINDER ###
-                query = data[(data['Age at Biopsy'].between(pt_features['Age at Biopsy'][0] - 5,
-                                                       pt_features['Age at Biopsy'][0] + 5)) &
-                             (data['Worst Gleason Grade Group'] == pt_features['Worst Gleason Grade Group'][0]) &
-                             (data['PSA density'].between(pt_features['PSA density'][0] * 0.7,
-                                                        pt_features['PSA density'][0] * 1.3)) &
-                             (data['Perineural invasion'] == pt_features['Perineural invasion'][0]) &
-                             (data['% positive cores'].between(pt_features['% positive cores'][0] - 10,
-                                                             pt_features['% positive cores'][0] + 10)) &
-                             (data['% Gleason pattern 4/5'].between(pt_features['% Gleason pattern 4/5'][0] - 10,
-                                                                  pt_features['% Gleason pattern 4/5'][0] + 10)) &
-                             (data['Max % core involvement'].between(pt_features['Max % core involvement'][0] - 10,
-                                                                   pt_features['Max % core involvement'][0] + 10))
-                             ]
-                pos_ssEPE = sum(query['ssEPE'])
-                similar_cases = len(query['ssEPE'])
-
-                query_r = data[(data['Age at Biopsy'].between(pt_features_r['Age at Biopsy'][0] - 5,
-                                                            pt_features_r['Age at Biopsy'][0] + 5)) &
-                             (data['Worst Gleason Grade Group'] == pt_features_r['Worst Gleason Grade Group'][0]) &
-                             (data['PSA density'].between(pt_features_r['PSA density'][0] * 0.7,
-                                                          pt_features_r['PSA density'][0] * 1.3)) &
-                             (data['Perineural invasion'] == pt_features_r['Perineural invasion'][0]) &
-                             (data['% positive cores'].between(pt_features_r['% positive cores'][0] - 10,
-                                                               pt_features_r['% positive cores'][0] + 10)) &
-                             (data['% Gleason pattern 4/5'].between(pt_features_r['% Gleason pattern 4/5'][0] - 10,
-                                                                    pt_features_r['% Gleason pattern 4/5'][0] + 10)) &
-                             (data['Max % core involvement'].between(pt_features_r['Max % core involvement'][0] - 10,
-                                                                     pt_features_r['Max % core involvement'][0] + 10))
-                             ]
-                pos_ssEPE_r = sum(query_r['ssEPE'])
-                similar_cases_r = len(query_r['ssEPE'])
-
-                ### DISPLAY RESULTS ###
-                col4.header('Your Results')
-                col4.subheader('Probability of LEFT extraprostatic extension: {}%'.format(left_prob))
-                col4.caption('For every 10 patients with your disease profile, about {} patients will have tumour that '
-                             'has extended beyond the left side of the prostate.'
-                             .format(str((model.predict_proba(pt_features)[:, 1] * 10).round())[1:-2]))
-                if similar_cases == 0:
-                    col4.caption('No patients with similar characteristics were found in our database.')
-                else:
-                    col4.caption("From our database, {:} out of {:} patients ({:}%) with similar characteristics "
-                                 "on the left side had left extraprostatic extension."
-                                 .format(pos_ssEPE, similar_cases, round((pos_ssEPE/similar_cases)*100)))
-                col4.subheader('Probability of RIGHT extraprostatic extension: {}%'.format(right_prob))
-                col4.caption('For every 10 patients with your disease profile, about {} patients will have tumour that '
-                             'has extended beyond the right side of the prostate.'
-                           .format(str((model.predict_proba(pt_features_r)[:, 1] * 10).round())[1:-2]))
-                if similar_cases_r == 0:
-                    col4.caption('No patients with similar characteristics were found in our database.')
-                else:
-                    col4.caption("From our database, {:} out of {:} patients ({:}%) with similar characteristics "
-                                 "on the right side had right extraprostatic extension."
-                                 .format(pos_ssEPE_r, similar_cases_r, round((pos_ssEPE_r/similar_cases_r)*100)))
-                col5.header('Prostate Diagram')
-                col5.image(image, use_column_width=True)
+                with metrics.span('similar_cases'):
+                    pos_ssEPE, similar_cases = index.query(pt_features[0])
+                    pos_ssEPE_r, similar_cases_r = index.query(pt_features_r[0])
+                    # 95% Wilson score intervals of the similar case rates
+                    (low, low_r), (high, high_r) = wilson([pos_ssEPE, pos_ssEPE_r], [similar_cases, similar_cases_r])
+                metrics.increment('empty_similar_cases_total', (similar_cases == 0) + (similar_cases_r == 0))
+
+                ### AUDIT LOG ###
+                # Queue the prediction for the write-behind audit log, which writes it from a background thread
+                audit_log = resources.get('audit')
+                if audit_log is not None:
+                    result = {'left': {'probability': float(prob), 'pos_ssEPE': pos_ssEPE,
+                                       'similar_cases': similar_cases},
+                              'right': {'probability': float(prob_r), 'pos_ssEPE': pos_ssEPE_r,
+                                        'similar_cases': similar_cases_r}}
+                    audit_log.record(make_record(dict(zip(INPUTS, inputs[0].tolist())), result,
+                                                 resources.version('model')))
+
+                ### SESSION STATE ###
+                # Keep only the raw inputs and results in the session state, and the render results in the shared
+                # store, so that they are shown again when the page reruns
+                token = session.save(st.session_state, inputs[0], {
+                    'prob': prob, 'prob_r': prob_r, 'pos_ssEPE': pos_ssEPE, 'similar_cases': similar_cases,
+                    'pos_ssEPE_r': pos_ssEPE_r, 'similar_cases_r': similar_cases_r, 'low': low, 'high': high,
+                    'low_r': low_r, 'high_r': high_r})
+                # Show the results before rendering the diagram, attributions and curves
+                col4, col5 = show_results(session.load(st.session_state)['result'])
+                renders = render_results(inputs, features)
+                session.RENDERS.put(token, renders)
+                show_renders(col4, col5, renders)
+
+        else:
+            # Show the results of the last submit again, e.g. after switching pages. Render results evicted from the
+            # shared store are rebuilt from the saved raw inputs, and attributions left out are added once the
+            # explainer is loaded.
+            saved = session.load(st.session_state)
+            if saved is not None:
+                import numpy as np
+                col4, col5 = show_results(saved['result'])
+                inputs = np.array([saved['inputs']])
+                renders = session.RENDERS.get(saved['token'])
+                if renders is None:
+                    renders = render_results(inputs)
+                    session.RENDERS.put(saved['token'], renders)
+                elif renders.attributions is None and resources.loaded('explainer'):
+                    renders = renders._replace(attributions=explain_lobes(inputs))
+                    session.RENDERS.put(saved['token'], renders)
+                show_renders(col4, col5, renders)
+
+    # Now that the page is drawn, load the model, reference cohort and images in the background (once per process)
+    resources.prewarm()
+
+
+def render_results(inputs, features=None):
+    """
+    Render the prostate diagram, feature attributions and what-if curves of a patient's row of raw inputs with the
+    model, explainer and diagram renderer shared by every session.
+    """
+    import sweep
+    from features import INPUTS, LEFT_INPUTS, RIGHT_INPUTS, build_features
+
+    if features is None:
+        features = build_features(inputs)
+
+    ### ANNOTATED PROSTATE DIAGRAM ###
+    # Colour code each site by Gleason Grade Group and overlay its % core involvement. The findings are passed as
+    # integers, as entered in the form, so that every session with the same sites shares the same cached diagram.
+    sites = [inputs[0, INPUTS.index(name)] for name in LEFT_INPUTS[:6] + RIGHT_INPUTS[:6]]
+    with metrics.span('diagram'):
+        image = resources.get('renderer').render_encoded(
+            *[int(value) if i % 2 == 0 else float(value) for i, value in enumerate(sites)])
+
+    ### FEATURE ATTRIBUTIONS ###
+    attributions = explain_lobes(inputs, features)
+
+    ### WHAT-IF SWEEP ###
+    # Score the whole grid of perturbed inputs with a single model call
+    with metrics.span('sweep'):
+        curves = sweep.curves(resources.get('model'), inputs)
+    return session.Renders(image, attributions, curves)
+
+
+def explain_lobes(inputs, features=None):
+    """
+    Explain both lobes in one (cached) batch with the explainer shared by every session.
+
+    Returns None, rather than waiting, while the explainer is still being built in the background, and if it fails to
+    build or explain (e.g. a store without the model's trees), so that the results never depend on it.
+    """
+    if not resources.load_in_background('explainer'):
+        return None
+    from features import build_features
+    if features is None:
+        features = build_features(inputs)
+    try:
+        with metrics.span('explain'):
+            return resources.get('explainer').explain(features)
+    except Exception:
+        metrics.increment('explain_errors_total')
+        return None
+
+
+def show_results(result):
+    """Show the results of both lobes saved by session.save, and return the columns for their render results."""
+    prob, prob_r = result['prob'], result['prob_r']
+    pos_ssEPE, similar_cases, low, high = result['pos_ssEPE'], result['similar_cases'], result['low'], result['high']
+    pos_ssEPE_r, similar_cases_r = result['pos_ssEPE_r'], result['similar_cases_r']
+    low_r, high_r = result['low_r'], result['high_r']
+    left_prob = round(prob * 100)
+    right_prob = round(prob_r * 100)
+
+    ### DISPLAY RESULTS ###
+    col4, col5 = st.columns([1, 2])
+    col4.header('Your Results')
+    col4.subheader('Probability of LEFT extraprostatic extension: {}%'.format(left_prob))
+    col4.caption('For every 10 patients with your disease profile, about {} patients will have tumour that '
+                 'has extended beyond the left side of the prostate.'
+                 .format(round(prob * 10)))
+    if similar_cases == 0:
+        col4.caption('No patients with similar characteristics were found in our database.')
+    else:
+        col4.caption("From our database, {:} out of {:} patients ({:}%, 95% CI {:}% to {:}%) with similar "
+                     "characteristics on the left side had left extraprostatic extension."
+                     .format(pos_ssEPE, similar_cases, round((pos_ssEPE/similar_cases)*100),
+                             round(low * 100), round(high * 100)))
+    col4.subheader('Probability of RIGHT extraprostatic extension: {}%'.format(right_prob))
+    col4.caption('For every 10 patients with your disease profile, about {} patients will have tumour that '
+                 'has extended beyond the right side of the prostate.'
+               .format(round(prob_r * 10)))
+    if similar_cases_r == 0:
+        col4.caption('No patients with similar characteristics were found in our database.')
+    else:
+        col4.caption("From our database, {:} out of {:} patients ({:}%, 95% CI {:}% to {:}%) with similar "
+                     "characteristics on the right side had right extraprostatic extension."
+                     .format(pos_ssEPE_r, similar_cases_r, round((pos_ssEPE_r/similar_cases_r)*100),
+                             round(low_r * 100), round(high_r * 100)))
+    return col4, col5
+
+
+def show_renders(col4, col5, renders):
+    """Show the feature attributions, what-if curves and prostate diagram of a result."""
+    import pandas as pd
+    from features import FEATURES
+
+    with col4.expander('Why did each lobe score this way?'):
+        if renders.attributions is None:
+            st.caption('Feature contributions are not available at the moment.')
+        else:
+            st.caption('Contribution of each feature to the risk of each lobe (SHAP values, in log-odds). '
+                       'Positive values increase the probability of extraprostatic extension and negative '
+                       'values decrease it.')
+            st.table(pd.DataFrame(renders.attributions.T, index=FEATURES, columns=['Left', 'Right']).round(3))
+
+    with col4.expander('How would the results change?'):
+        st.caption('Probability (%) of left and right extraprostatic extension as one input varies and '
+                   'all other inputs stay as entered.')
+        for name, curve in renders.curves.items():
+            st.caption(curve.index.name)
+            st.line_chart(curve * 100)
+    col5.header('Prostate Diagram')
+    col5.image(renders.image, use_column_width=True)
 
 
 
@@ -494,5 +389,6 @@ if __name__ == "__main__":
                        layout="wide",
                        initial_sidebar_state="auto"
                        )
+    metrics.start()
     load_widget_state()
     main()
@@ -0,0 +1,171 @@
+"""
+Model and reference cohort artifacts for SEPERA.
+
+The trained model is a sigmoid-calibrated ensemble of XGBoost classifiers (a pickled CalibratedClassifierCV). Besides
+the original pickles, it can be stored as a directory of native XGBoost boosters (JSON, or UBJ with XGBoost >= 1.6)
+next to a calibration.json file holding the sigmoid parameters, and the reference cohort as a memory-mapped .npy
+matrix (with its column names in a .json sidecar) along with its prebuilt similar case index (see
+similar.SimilarCaseIndex.save). These load much faster than the pickles, and worker processes on the same host share
+the pages of the cohort and of the index the queries read, instead of each holding a copy. The boosters are still
+loaded by each process. The bundled Model/SEPERA.zip is read directly without extracting it.
+
+Usage:
+    python artifacts.py --model Model/SEPERA.zip --data model/data.pkl --out model
+"""
+
+import argparse
+import json
+import zipfile
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from provision import BUNDLED_MODEL
+
+CALIBRATION = 'calibration.json'
+
+
+class NativeModel:
+    """
+    Sigmoid-calibrated ensemble of native XGBoost boosters, scoring like the pickled CalibratedClassifierCV.
+
+    Each booster's probability f is calibrated as 1 / (1 + exp(a * f + b)) and the calibrated probabilities are
+    averaged over the ensemble.
+    """
+
+    def __init__(self, boosters, calibration, missing):
+        self.boosters = boosters
+        self.calibration = calibration
+        self.missing = missing
+
+    @classmethod
+    def load(cls, directory):
+        import xgboost
+        directory = Path(directory)
+        manifest = json.loads((directory / CALIBRATION).read_text())
+        boosters = [xgboost.Booster(model_file=str(directory / member['booster'])) for member in manifest['members']]
+        calibration = [(member['a'], member['b']) for member in manifest['members']]
+        return cls(boosters, calibration, manifest['missing'])
+
+    def predict_proba(self, features):
+        features = np.asarray(features, dtype=np.float32)
+        prob = np.zeros(len(features))
+        for booster, (a, b) in zip(self.boosters, self.calibration):
+            f = booster.inplace_predict(features, missing=self.missing)
+            prob += f if a is None else 1 / (1 + np.exp(a * f + b))
+        prob /= len(self.boosters)
+        return np.column_stack([1 - prob, prob])
+
+
+def _members(model):
+    """Return the XGBoost classifier and sigmoid parameters (or None) of each member of a pickled model."""
+    if not hasattr(model, 'calibrated_classifiers_'):
+        return [(model, None, None)]
+    members = []
+    for calibrated in model.calibrated_classifiers_:
+        # The attribute names changed across scikit-learn versions
+        estimator = getattr(calibrated, 'estimator', None) or calibrated.base_estimator
+        calibrator = (getattr(calibrated, 'calibrators', None) or calibrated.calibrators_)[0]
+        members.append((estimator, float(calibrator.a_), float(calibrator.b_)))
+    return members
+
+
+def boosters(model):
+    """Return the XGBoost boosters of a native or pickled model, along with the feature value it treats as missing."""
+    if isinstance(model, NativeModel):
+        return model.boosters, model.missing
+    if not hasattr(model, 'calibrated_classifiers_') and not hasattr(model, 'get_booster'):
+        raise TypeError("{} has no XGBoost boosters".format(type(model).__name__))
+    members = _members(model)
+    return [estimator.get_booster() for estimator, _, _ in members], float(members[0][0].missing)
+
+
+def load_model(path):
+    """Load the model from a compiled .npz file, a directory of native boosters, a zipped pickle or a pickle."""
+    path = Path(path)
+    if path.suffix == '.npz':
+        from trees import CompiledModel
+        return CompiledModel.load(path)
+    if path.is_dir():
+        return NativeModel.load(path)
+    if path.suffix == '.zip':
+        with zipfile.ZipFile(path) as archive:
+            name = next(name for name in archive.namelist() if name.endswith('.pkl'))
+            with archive.open(name) as file:
+                return joblib.load(file)
+    return joblib.load(path)
+
+
+def load_cohort(path):
+    """
+    Load the reference cohort from a .npy matrix, a Feather file or a pickle.
+
+    A .npy matrix is memory-mapped read-only and wrapped in a DataFrame without copying it.
+    """
+    path = Path(path)
+    if path.suffix == '.npy':
+        values = np.load(path, mmap_mode='r')
+        columns = json.loads(path.with_suffix('.json').read_text())
+        return pd.DataFrame(values, columns=columns, copy=False)
+    if path.suffix == '.feather':
+        import pyarrow.feather
+        return pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+    return joblib.load(path)
+
+
+def export_model(model, directory, format='json'):
+    """Save the boosters of a pickled model in XGBoost's native format ('json' or 'ubj') along with its calibration."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    members = []
+    missing = None
+    for i, (estimator, a, b) in enumerate(_members(model)):
+        name = 'booster_{}.{}'.format(i, format)
+        estimator.get_booster().save_model(str(directory / name))
+        members.append({'booster': name, 'a': a, 'b': b})
+        missing = float(estimator.missing)
+    (directory / CALIBRATION).write_text(json.dumps({'missing': missing, 'members': members}, indent=2))
+
+
+def export_cohort(data, path):
+    """
+    Save the numeric columns of the reference cohort for fast loading, as a .npy matrix or a Feather file.
+
+    The .npy matrix is stored column-major so that each column is contiguous once memory-mapped.
+    """
+    path = Path(path)
+    if path.suffix == '.feather':
+        data.reset_index(drop=True).to_feather(path)
+        return
+    numeric = data.select_dtypes(include=['number', 'bool'])
+    np.save(path, np.asfortranarray(numeric.to_numpy(dtype=float)))
+    path.with_suffix('.json').write_text(json.dumps(list(numeric.columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the SEPERA model and reference cohort to fast formats.")
+    parser.add_argument('--model', default=str(BUNDLED_MODEL), help="Path to the pickled (or zipped) model")
+    parser.add_argument('--data', default='model/data.pkl', help="Path to the pickled reference cohort")
+    parser.add_argument('--out', default='model',
+                        help="Directory to write the SEPERA boosters, SEPERA.npz, data.npy and the similar case "
+                             "index to")
+    parser.add_argument('--format', default='json', choices=['json', 'ubj'], help="Native booster format")
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.mkdir(exist_ok=True)
+    export_model(load_model(args.model), out / 'SEPERA', args.format)
+    if args.format == 'json':
+        from trees import compile_model
+        compile_model(out / 'SEPERA').save(out / 'SEPERA.npz')
+    if Path(args.data).exists():
+        from similar import SimilarCaseIndex
+        cohort = load_cohort(args.data)
+        export_cohort(cohort, out / 'data.npy')
+        SimilarCaseIndex(cohort).save(out / 'similar')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Write-behind audit log of SEPERA predictions.
+
+Every prediction (raw inputs, probability and similar case counts of both lobes, model version) is queued in memory and
+written by a background thread in batches to JSON-lines files, so recording a prediction does not slow down the
+request. Files are rotated once they reach max_bytes, and each process writes to its own files. When the queue is full,
+record() waits up to put_timeout seconds (policy 'block') or gives up at once (policy 'drop'). Records that cannot be
+queued or written (e.g. disk full) are dropped and counted, and the background thread keeps draining the queue.
+
+The log is written to SEPERA_AUDIT_DIR (audit by default), and SEPERA_AUDIT=0 turns it off.
+
+Replay re-scores the logged inputs in batch with the current model and reports how far the probabilities moved, to
+detect drift after a model or dependency change:
+    python audit.py replay audit --model model/SEPERA.npz --out drift.csv
+"""
+
+import argparse
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+from pathlib import Path
+
+import metrics
+
+MAX_QUEUE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_BYTES = 64 << 20
+PUT_TIMEOUT = 0.05
+# Longest wait for the queued records to be written when the log is closed, e.g. at exit
+CLOSE_TIMEOUT = 5.0
+
+_STOP = object()
+
+
+def make_record(inputs, result, model_version=None, source='app'):
+    """
+    Build the audit record of one patient.
+
+    inputs maps the raw input names to their values, and result holds the 'left' and 'right' lobe results as returned
+    by service.score: probability, pos_ssEPE and similar_cases.
+    """
+    return {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'source': source,
+            'model_version': model_version, 'inputs': inputs, 'left': result['left'], 'right': result['right']}
+
+
+class AuditLog:
+    """Bounded queue of audit records, flushed to rotating JSON-lines files by a background thread."""
+
+    def __init__(self, directory, max_queue=MAX_QUEUE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=MAX_BYTES, policy='block', put_timeout=PUT_TIMEOUT):
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        self.directory = Path(directory)
+        self.queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.files = 0
+        self.path = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Return the log configured by SEPERA_AUDIT_DIR, or None if SEPERA_AUDIT=0."""
+        if os.environ.get('SEPERA_AUDIT', '1').lower() in ('0', 'false'):
+            return None
+        return cls(os.environ.get('SEPERA_AUDIT_DIR', 'audit'))
+
+    def record(self, record):
+        """Queue a record for writing. Returns False if the queue was full and the record was dropped."""
+        self._start()
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            metrics.increment('audit_dropped_total')
+            return False
+        return True
+
+    def flush(self):
+        """Wait until every queued record is written."""
+        if self._thread is not None:
+            self._start()
+            self.queue.join()
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Write the queued records and stop the background thread, waiting at most timeout seconds."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                return
+            thread.join(timeout)
+
+    def _start(self):
+        # Also restart a thread that died, so that records are never left to fill the queue
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='audit', daemon=True)
+                    self._thread.start()
+                    atexit.unregister(self.close)
+                    atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [record for record in batch if record is not _STOP]
+            try:
+                if records:
+                    self._write(records)
+            except Exception:
+                # Drop the batch and start a new file on the next write, which may succeed (e.g. once space is freed)
+                self.path = None
+                with self._lock:
+                    self.errors += 1
+                    self.dropped += len(records)
+                metrics.increment('audit_write_errors_total')
+                metrics.increment('audit_dropped_total', len(records))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(records) < len(batch):
+                return
+
+    def _write(self, records):
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+        if self.path is None or self.path.stat().st_size + len(data) > self.max_bytes:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.files += 1
+            self.path = self.directory / 'audit-{:%Y%m%dT%H%M%S}-{}-{}.jsonl'.format(
+                datetime.datetime.now(datetime.timezone.utc), os.getpid(), self.files)
+            self.path.touch()
+        with open(self.path, 'ab') as file:
+            file.write(data)
+        with self._lock:
+            self.written += len(records)
+        metrics.increment('audit_written_total', len(records))
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped, 'errors': self.errors}
+
+
+def read_records(directory):
+    """Yield the records of every audit file of a directory, oldest file first."""
+    for path in sorted(Path(directory).glob('audit-*.jsonl')):
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def replay(model, records, chunksize=50000):
+    """
+    Re-score logged records in batch and return a DataFrame comparing the logged and replayed probabilities.
+
+    Records are scored chunksize at a time, with one model call for both lobes of a chunk.
+    """
+    import itertools
+
+    import numpy as np
+    import pandas as pd
+
+    from features import INPUTS, build_features
+
+    records = iter(records)
+    frames = []
+    while True:
+        chunk = list(itertools.islice(records, chunksize))
+        if not chunk:
+            break
+        inputs = np.array([[record['inputs'][name] for name in INPUTS] for record in chunk], dtype=float)
+        prob = model.predict_proba(build_features(inputs))[:, 1]
+        frames.append(pd.DataFrame({
+            'time': [record['time'] for record in chunk],
+            'model_version': [record['model_version'] for record in chunk],
+            'left_prob': [record['left']['probability'] for record in chunk],
+            'right_prob': [record['right']['probability'] for record in chunk],
+            'left_replayed': prob[:len(chunk)],
+            'right_replayed': prob[len(chunk):],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=['time', 'model_version', 'left_prob', 'right_prob', 'left_replayed',
+                                     'right_replayed', 'difference'])
+    drift = pd.concat(frames, ignore_index=True)
+    drift['difference'] = np.maximum(np.abs(drift['left_replayed'] - drift['left_prob']),
+                                     np.abs(drift['right_replayed'] - drift['right_prob']))
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the SEPERA audit log to detect model drift.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_command = commands.add_parser('replay', help="Re-score logged inputs with the current model")
+    replay_command.add_argument('directory', help="Directory of the audit log")
+    replay_command.add_argument('--model', default='model/SEPERA.pkl', help="Path to the model to replay with")
+    replay_command.add_argument('--tolerance', type=float, default=1e-6,
+                                help="Largest probability difference that does not count as drift")
+    replay_command.add_argument('--out', help="CSV file to write the per-record comparison to")
+    args = parser.parse_args()
+
+    from artifacts import load_model
+    drift = replay(load_model(args.model), read_records(args.directory))
+    if args.out:
+        drift.to_csv(args.out, index=False)
+    drifted = drift[drift['difference'] > args.tolerance]
+    print("Replayed {} records: {} differ by more than {}".format(len(drift), len(drifted), args.tolerance))
+    for version, group in drift.groupby('model_version', dropna=False):
+        print("  model {}: {} records, largest difference {:.2e}".format(version, len(group),
+                                                                         group['difference'].max()))
+    if len(drifted):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
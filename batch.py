@@ -0,0 +1,200 @@
+"""
+Headless batch scoring for SEPERA.
+
+Scores a whole cohort of patients from a CSV or Parquet extract without the Streamlit UI. The input file needs one
+column per raw form input (see features.INPUTS). The output file holds the input columns followed by the validation
+error (if any) and the probability of side-specific extraprostatic extension for the left and right lobe. When a
+reference cohort is given, the similar case counts of each lobe are added as well (with --intervals, along with 95%
+confidence intervals of the similar case rates, and with --bands, the lowest and highest similar case rate as the
+similarity tolerances are narrowed and widened, see intervals.py), and with --explain the SHAP values of every feature
+of each lobe (see explain.py).
+
+Usage:
+    python batch.py patients.csv predictions.csv --model model/SEPERA.pkl --chunksize 50000
+    python batch.py patients.csv predictions.csv --cohort model/data.pkl
+    python batch.py patients.csv predictions.csv --cohort model/data.pkl --intervals bootstrap --workers 8
+    python batch.py patients.csv predictions.csv --cohort model/data.pkl --bands
+    python batch.py patients.csv predictions.csv --model model/SEPERA --explain
+"""
+
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from artifacts import load_cohort, load_model
+from features import FEATURES, build_features, input_matrix, range_errors, validation_errors
+from intervals import bootstrap, bootstrap_parallel, tolerance_bands, wilson
+from similar import SimilarCaseIndex
+
+CHUNKSIZE = 50000
+
+
+def read_chunks(path, chunksize=CHUNKSIZE):
+    """Stream a CSV or Parquet file of raw inputs as DataFrames of at most chunksize rows."""
+    path = Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        for record_batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield record_batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+def score_chunk(model, inputs, index=None, explainer=None, intervals=None, workers=1, executor=None, bands=False):
+    """
+    Score one chunk of patients, calling predict_proba once for both lobes of all valid patients.
+
+    If a SimilarCaseIndex is given, the similar case counts of both lobes are computed in one batch query as well, and
+    if a LobeExplainer is given, the SHAP values of both lobes are computed in one batch. intervals ('wilson' or
+    'bootstrap') adds confidence intervals of the similar case rates, bootstrapped on workers processes (of executor, if
+    given). bands adds the range of the similar case rates over the tolerance scales of intervals.tolerance_bands.
+    """
+    matrix = input_matrix(inputs)
+    # Extracts bypass the form, so check the ranges of its widgets (and blank cells) before its cross-field rules
+    errors = range_errors(matrix)
+    in_range = np.equal(errors, None)
+    errors[in_range] = validation_errors(matrix[in_range])
+    valid = np.equal(errors, None)
+    n = int(valid.sum())
+
+    left_prob = np.full(len(inputs), np.nan)
+    right_prob = np.full(len(inputs), np.nan)
+    pos = np.zeros(2 * len(inputs), dtype=np.int64)
+    total = np.zeros(2 * len(inputs), dtype=np.int64)
+    attributions = np.full((2 * len(inputs), len(FEATURES)), np.nan)
+    band_low = np.full(2 * len(inputs), np.nan)
+    band_high = np.full(2 * len(inputs), np.nan)
+    if n:
+        features = build_features(matrix[valid])
+        prob = model.predict_proba(features)[:, 1]
+        left_prob[valid] = prob[:n]
+        right_prob[valid] = prob[n:]
+        if index is not None:
+            both = np.concatenate([valid, valid])
+            pos[both], total[both] = index.query_batch(features)
+            if bands:
+                band_low[both], band_high[both], _ = tolerance_bands(index, features)
+        if explainer is not None:
+            # Rows of a batch run rarely repeat, so bypass the attribution cache
+            attributions[np.concatenate([valid, valid])] = explainer.explain(features, cache=False)
+
+    scored = inputs.copy()
+    scored['error'] = errors
+    scored['left_prob'] = left_prob
+    scored['right_prob'] = right_prob
+    if index is not None:
+        # Counts are missing for patients that failed validation
+        missing = ~np.concatenate([valid, valid])
+        scored['pos_ssEPE'] = pd.arrays.IntegerArray(pos[:len(inputs)], missing[:len(inputs)])
+        scored['similar_cases'] = pd.arrays.IntegerArray(total[:len(inputs)], missing[:len(inputs)])
+        scored['pos_ssEPE_r'] = pd.arrays.IntegerArray(pos[len(inputs):], missing[len(inputs):])
+        scored['similar_cases_r'] = pd.arrays.IntegerArray(total[len(inputs):], missing[len(inputs):])
+        if intervals is not None:
+            # Patients without similar cases (or that failed validation) have no interval
+            if intervals == 'wilson':
+                low, high = wilson(pos, total)
+            elif workers > 1:
+                low, high = bootstrap_parallel(pos, total, workers=workers, executor=executor)
+            else:
+                low, high = bootstrap(pos, total)
+            scored['similar_low'] = low[:len(inputs)]
+            scored['similar_high'] = high[:len(inputs)]
+            scored['similar_low_r'] = low[len(inputs):]
+            scored['similar_high_r'] = high[len(inputs):]
+        if bands:
+            scored['band_low'] = band_low[:len(inputs)]
+            scored['band_high'] = band_high[:len(inputs)]
+            scored['band_low_r'] = band_low[len(inputs):]
+            scored['band_high_r'] = band_high[len(inputs):]
+    if explainer is not None:
+        for j, feature in enumerate(FEATURES):
+            scored['left_shap: ' + feature] = attributions[:len(inputs), j]
+        for j, feature in enumerate(FEATURES):
+            scored['right_shap: ' + feature] = attributions[len(inputs):, j]
+    return scored
+
+
+class _Writer:
+    """Append scored chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.parquet_writer = None
+        self.header = True
+
+    def write(self, scored):
+        if self.path.suffix == '.parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.parquet_writer is None:
+                # Fix the schema on the first chunk, where the error column may be all null
+                schema = pa.Schema.from_pandas(scored, preserve_index=False)
+                schema = schema.set(schema.get_field_index('error'), pa.field('error', pa.string()))
+                self.parquet_writer = pq.ParquetWriter(self.path, schema)
+            table = pa.Table.from_pandas(scored, schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        else:
+            scored.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def score_file(model, input_path, output_path, chunksize=CHUNKSIZE, index=None, explainer=None, intervals=None,
+               workers=1, bands=False):
+    """Score every patient of input_path chunk by chunk and write the results to output_path."""
+    writer = _Writer(output_path)
+    n_scored = 0
+    with contextlib.ExitStack() as stack:
+        stack.callback(writer.close)
+        # One pool of bootstrap processes for the whole run, rather than one per chunk
+        executor = None
+        if intervals == 'bootstrap' and workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(workers))
+        for inputs in read_chunks(input_path, chunksize):
+            writer.write(score_chunk(model, inputs, index, explainer, intervals, workers, executor, bands))
+            n_scored += len(inputs)
+    return n_scored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a cohort of patients with SEPERA.")
+    parser.add_argument('input', help="CSV or Parquet file of raw form inputs")
+    parser.add_argument('output', help="CSV or Parquet file to write the predictions to")
+    parser.add_argument('--model', default='model/SEPERA.pkl', help="Path to the trained model (pickle, zipped pickle or native directory)")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help="Number of patients scored at a time")
+    parser.add_argument('--cohort', help="Path to the reference cohort, to add similar case counts")
+    parser.add_argument('--intervals', choices=['wilson', 'bootstrap'],
+                        help="Add 95%% confidence intervals of the similar case rates (needs --cohort)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes used to bootstrap the intervals")
+    parser.add_argument('--bands', action='store_true',
+                        help="Add the lowest and highest similar case rate over narrowed and widened similarity "
+                             "tolerances (needs --cohort)")
+    parser.add_argument('--explain', action='store_true',
+                        help="Add the SHAP values of each lobe (needs the native boosters or the pickled model)")
+    args = parser.parse_args()
+    if args.intervals and not args.cohort:
+        parser.error("--intervals needs --cohort")
+    if args.bands and not args.cohort:
+        parser.error("--bands needs --cohort")
+
+    model = load_model(args.model)
+    index = SimilarCaseIndex(load_cohort(args.cohort)) if args.cohort else None
+    explainer = None
+    if args.explain:
+        from explain import LobeExplainer
+        explainer = LobeExplainer(model)
+    n_scored = score_file(model, args.input, args.output, args.chunksize, index, explainer, args.intervals,
+                          args.workers, args.bands)
+    print("Scored {} patients".format(n_scored))
+
+
+if __name__ == "__main__":
+    main()
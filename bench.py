@@ -0,0 +1,241 @@
+"""
+Benchmarks of the SEPERA submit path.
+
+Times feature construction, model scoring, the similar case query at several cohort sizes and diagram compositing and
+encoding on synthetic patients, and reports the throughput and the p50/p95/p99 latency of each step. Everything runs
+offline: patients and reference cohorts are generated, and a stub model stands in for the trained model unless
+--model is given. The imports benchmark times the import of the app and of each heavy dependency in a fresh
+interpreter, which is what a cold start pays.
+
+Usage:
+    python bench.py
+    python bench.py similar --sizes 10000 100000 1000000 10000000
+    python bench.py predict --model model/SEPERA.npz --json results.json
+    python bench.py imports --repeat 10
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from features import FEATURES, GENERAL_INPUTS, INPUTS, LEFT_INPUTS, RIGHT_INPUTS, build_features, validation_errors
+from similar import EXACT_KEYS, OUTCOME, RANGE_KEYS
+
+BENCHMARKS = ['features', 'predict', 'similar', 'render', 'imports']
+# Benchmarks run when none is named
+DEFAULT_BENCHMARKS = ['features', 'predict', 'similar', 'render']
+SIZES = [10000, 100000, 1000000, 10000000]
+
+# Modules timed by the imports benchmark: the app itself, its heavy dependencies and the modules of the submit path
+IMPORTS = ['SEPERA', 'streamlit', 'numpy', 'pandas', 'PIL.Image', 'joblib', 'google_drive_downloader', 'sklearn',
+           'xgboost', 'shap', 'pyarrow', 'resources', 'features', 'inference', 'similar', 'diagram', 'artifacts']
+
+# Share of unknown (-1) entries in synthetic patients
+UNKNOWN = 0.05
+
+
+def synthetic_inputs(n, seed=0, unknown=UNKNOWN):
+    """
+    Generate an N x 21 matrix of raw inputs within the form's value ranges that pass its validation rules.
+
+    A share of the general inputs, biopsy sites and core counts is set to unknown (-1), as the form allows.
+    """
+    rng = np.random.default_rng(seed)
+    inputs = np.empty((n, len(INPUTS)))
+    column = INPUTS.index
+    inputs[:, column('age')] = rng.integers(40, 91, n)
+    inputs[:, column('psa')] = np.round(rng.lognormal(2, 0.7, n).clip(0.1, 200), 2)
+    inputs[:, column('vol')] = np.round(rng.lognormal(3.7, 0.4, n).clip(5, 300), 1)
+    inputs[:, column('p_high')] = rng.integers(0, 21, n) * 5.0
+    inputs[:, column('perineural_inv')] = rng.integers(0, 2, n)
+    for name in GENERAL_INPUTS:
+        inputs[rng.random(n) < unknown, column(name)] = -1
+
+    for names in [LEFT_INPUTS, RIGHT_INPUTS]:
+        findings = [column(name) for name in names[0:6:2]]
+        p_inv = [column(name) for name in names[1:6:2]]
+        pos_core, taken_core = column(names[6]), column(names[7])
+        for site_findings, site_p_inv in zip(findings, p_inv):
+            # Normal sites have no core involvement and unknown sites have unknown involvement
+            inputs[:, site_findings] = rng.integers(0, 6, n)
+            inputs[:, site_p_inv] = np.where(inputs[:, site_findings] == 0, 0, rng.integers(1, 21, n) * 5.0)
+            inputs[np.ix_(rng.random(n) < unknown, [site_findings, site_p_inv])] = -1
+        inputs[:, taken_core] = rng.integers(1, 31, n)
+        inputs[:, pos_core] = rng.integers(0, inputs[:, taken_core] + 1)
+        inputs[np.ix_(rng.random(n) < unknown, [pos_core, taken_core])] = -1
+
+    assert np.equal(validation_errors(inputs), None).all()
+    return inputs
+
+
+def synthetic_cohort(n, seed=0):
+    """Generate a reference cohort of n lobes with the columns used by the similar case finder."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Age at Biopsy': rng.integers(40, 91, n).astype(float),
+        'Worst Gleason Grade Group': rng.integers(-1, 6, n).astype(float),
+        'PSA density': rng.gamma(2, 0.1, n),
+        'Perineural invasion': rng.integers(-1, 2, n).astype(float),
+        '% positive cores': np.round(rng.random(n) * 100),
+        '% Gleason pattern 4/5': rng.integers(0, 21, n) * 5.0,
+        'Max % core involvement': rng.integers(0, 21, n) * 5.0,
+        'ssEPE': rng.integers(0, 2, n),
+    })[EXACT_KEYS + RANGE_KEYS + [OUTCOME]]
+
+
+class StubModel:
+    """Cheap stand-in for the trained model: a fixed logistic function of the lobe features."""
+
+    weights = np.linspace(-0.5, 0.5, len(FEATURES)) / 10
+
+    def predict_proba(self, features):
+        prob = 1 / (1 + np.exp(-np.asarray(features, dtype=float) @ self.weights))
+        return np.column_stack([1 - prob, prob])
+
+
+def measure(func, repeat, warmup=1):
+    """Call func warmup + repeat times and return the duration of the timed calls, in seconds."""
+    for _ in range(warmup):
+        func()
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def result(name, times, items=1):
+    """Summarize the timed calls of a benchmark processing items rows per call."""
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    return {'name': name, 'calls': len(times), 'items': items, 'throughput': items / times.mean(),
+            'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+def bench_features(repeat):
+    patient = synthetic_inputs(1)
+    batch = synthetic_inputs(10000, seed=1)
+    return [result('validation_errors[1]', measure(lambda: validation_errors(patient), repeat)),
+            result('build_features[1]', measure(lambda: build_features(patient), repeat)),
+            result('build_features[10000]', measure(lambda: build_features(batch), max(1, repeat // 50)), 10000)]
+
+
+def bench_predict(repeat, model):
+    from inference import PredictionCache, predict
+    lobes = build_features(synthetic_inputs(1))
+    batch = build_features(synthetic_inputs(10000, seed=1))
+    cache = PredictionCache()
+    return [result('predict_proba[2]', measure(lambda: model.predict_proba(lobes), repeat), 2),
+            result('predict_proba[20000]', measure(lambda: model.predict_proba(batch), max(1, repeat // 50)), 20000),
+            result('predict cached[2]', measure(lambda: predict(model, lobes, cache), repeat), 2)]
+
+
+def bench_similar(repeat, sizes):
+    from similar import SimilarCaseIndex
+    lobes = build_features(synthetic_inputs(1))
+    batch = build_features(synthetic_inputs(1000, seed=1))
+    results = []
+    for size in sizes:
+        cohort = synthetic_cohort(size)
+        start = time.perf_counter()
+        index = SimilarCaseIndex(cohort)
+        results.append(result('SimilarCaseIndex[{}]'.format(size), np.array([time.perf_counter() - start]), size))
+        del cohort
+        results.append(result('query[{}]'.format(size), measure(lambda: index.query(lobes[0]), repeat)))
+        results.append(result('query_batch[{}] x 2000'.format(size),
+                              measure(lambda: index.query_batch(batch), max(1, repeat // 50)), 2000))
+        # The same lobes one query at a time, which query_batch must beat
+        results.append(result('query loop[{}] x 2000'.format(size),
+                              measure(lambda: [index.query(row) for row in batch], max(1, repeat // 50)), 2000))
+    return results
+
+
+def bench_render(repeat):
+    from diagram import DISPLAY_WIDTH, DiagramRenderer, encode
+    renderer = DiagramRenderer(width=DISPLAY_WIDTH)
+    sites = synthetic_inputs(repeat + 1, seed=2)[:, [INPUTS.index(name) for name in
+                                                     LEFT_INPUTS[:6] + RIGHT_INPUTS[:6]]]
+    site_inputs = [[int(value) if i % 2 == 0 else float(value) for i, value in enumerate(row)] for row in sites]
+    calls = iter(site_inputs)
+    results = [result('render', measure(lambda: renderer._render(*next(calls)), repeat))]
+    image = renderer.render(*site_inputs[0])
+    for format in ['WEBP', 'PNG', 'JPEG']:
+        results.append(result('encode {}'.format(format), measure(lambda: encode(image, format), repeat)))
+    return results
+
+
+def import_time(module):
+    """Return the time taken to import a module in a fresh interpreter, or None if it cannot be imported."""
+    code = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'.format(module)
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                               cwd=Path(__file__).resolve().parent)
+    if completed.returncode != 0:
+        return None
+    return float(completed.stdout.split()[-1])
+
+
+def bench_imports(repeat):
+    results = []
+    for module in IMPORTS:
+        times = [import_time(module) for _ in range(repeat)]
+        if None not in times:
+            results.append(result('import {}'.format(module), np.array(times)))
+    return results
+
+
+def run(benchmarks, repeat=200, sizes=SIZES, model=None):
+    """Run the selected benchmarks and return their results."""
+    results = []
+    if 'features' in benchmarks:
+        results += bench_features(repeat)
+    if 'predict' in benchmarks:
+        results += bench_predict(repeat, model or StubModel())
+    if 'similar' in benchmarks:
+        results += bench_similar(repeat, sizes)
+    if 'render' in benchmarks:
+        results += bench_render(repeat)
+    if 'imports' in benchmarks:
+        results += bench_imports(max(1, repeat // 20))
+    return results
+
+
+def report(results):
+    print('{:<32} {:>7} {:>14} {:>10} {:>10} {:>10}'.format('benchmark', 'calls', 'rows/s', 'p50 ms', 'p95 ms',
+                                                            'p99 ms'))
+    for row in results:
+        print('{name:<32} {calls:>7} {throughput:>14,.0f} {p50_ms:>10.3f} {p95_ms:>10.3f} {p99_ms:>10.3f}'
+              .format(**row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SEPERA submit path on synthetic patients.")
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help="Benchmarks to run, among {} (all but imports by default)".format(', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat', type=int, default=200, help="Number of timed calls per benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="Reference cohort sizes")
+    parser.add_argument('--model', help="Path to a model to time instead of the stub model")
+    parser.add_argument('--json', help="File to save the results to, for comparison across runs")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(', '.join(sorted(unknown))))
+
+    model = None
+    if args.model:
+        from artifacts import load_model
+        model = load_model(args.model)
+    results = run(args.benchmarks or DEFAULT_BENCHMARKS, args.repeat, args.sizes, model)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
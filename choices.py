@@ -0,0 +1,14 @@
+"""
+Labels of the choices offered by the SEPERA form.
+
+Kept free of heavy imports, so that the form can be drawn before NumPy, pandas or PIL are loaded.
+"""
+
+# Labels of the Gleason Grade Group choices
+G_CHOICES = {0: 'Normal',
+             1: 'ISUP Grade 1',
+             2: 'ISUP Grade 2',
+             3: 'ISUP Grade 3',
+             4: 'ISUP Grade 4',
+             5: 'ISUP Grade 5',
+             -1: 'Unknown'}
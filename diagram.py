@@ -0,0 +1,138 @@
+"""
+Annotated prostate diagram for SEPERA.
+
+Draws the biopsy findings of each site onto the blank prostate diagram: a colour coded overlay for the Gleason Grade
+Group and a caption with the % core involvement. All overlays and the font are loaded once, and encoded diagrams are
+memoized on the site inputs. Only the last few composited images are kept, since each one takes megabytes.
+
+Diagrams can be composited at a lower resolution than the source images (overlays, positions and font are scaled
+together) and encoded to PNG, WebP or JPEG, which keeps rendering cheap and responses small on slow links.
+"""
+
+import functools
+import io
+from pathlib import Path
+
+import PIL.Image
+from PIL import ImageDraw, ImageFont, ImageOps
+
+from choices import G_CHOICES
+
+IMAGES = Path('Images')
+
+# Overlay name, whether the overlay is mirrored, overlay position and caption position of each site, in the order of
+# the render arguments
+SITES = [('Base', False, (495, 1615), (655, 1920)),
+         ('Mid', False, (495, 965), (655, 1190)),
+         ('Apex', False, (495, 187), (735, 545)),
+         ('Base', True, (1665, 1615), (1850, 1920)),
+         ('Mid', False, (1665, 965), (1850, 1190)),
+         ('Apex', True, (1665, 187), (1770, 545))]
+
+GRADES = [1, 2, 3, 4, 5]
+FONT_SIZE = 80
+# Number of composited (RGBA) diagrams kept, e.g. to encode the same diagram in several formats
+IMAGE_CACHE_SIZE = 4
+
+# Encodings accepted by encode
+FORMATS = ['PNG', 'WEBP', 'JPEG']
+
+# Resolution and encoding of the diagram shown by the web app
+DISPLAY_WIDTH = 1200
+DISPLAY_FORMAT = 'WEBP'
+DISPLAY_QUALITY = 80
+
+
+def caption(findings, p_inv):
+    """Return the caption of a site showing its Gleason Grade Group and % core involvement."""
+    if findings <= 0 or p_inv <= 0:
+        return str(G_CHOICES[findings]) + '\n' + '% core involvement: n/a'
+    return str(G_CHOICES[findings]) + '\n' + '% core involvement: ' + str(p_inv)
+
+
+class DiagramRenderer:
+    """
+    Composites annotated prostate diagrams from overlays loaded once at startup.
+
+    If width is given, diagrams are composited at that width instead of the width of the source diagram. cache_size
+    encoded diagrams (tens of kilobytes each) and image_cache_size composited images (megabytes each) are memoized.
+    """
+
+    def __init__(self, images=IMAGES, width=None, cache_size=256, image_cache_size=IMAGE_CACHE_SIZE):
+        images = Path(images)
+        base = PIL.Image.open(images / 'Prostate diagram.png').convert('RGBA')
+        self.scale = 1 if width is None else width / base.width
+        self.base = self._resize(base)
+        self.font = ImageFont.truetype(str(images / 'Font.ttf'), max(1, round(FONT_SIZE * self.scale)))
+        self.sites = [(site, mirrored, self._position(overlay_position), self._position(caption_position))
+                      for site, mirrored, overlay_position, caption_position in SITES]
+
+        # Overlays keyed on (site, mirrored, grade), converted to RGBA, scaled and mirrored up front
+        self.overlays = {}
+        for site, mirrored, _, _ in SITES:
+            for grade in GRADES:
+                overlay = self._resize(PIL.Image.open(images / '{} {}.png'.format(site, grade)).convert('RGBA'))
+                self.overlays[site, mirrored, grade] = ImageOps.mirror(overlay) if mirrored else overlay
+
+        self.render = functools.lru_cache(maxsize=image_cache_size)(self._render)
+        self.render_encoded = functools.lru_cache(maxsize=cache_size)(self._render_encoded)
+
+    def _resize(self, image):
+        if self.scale == 1:
+            return image
+        size = (max(1, round(image.width * self.scale)), max(1, round(image.height * self.scale)))
+        return image.resize(size, PIL.Image.LANCZOS)
+
+    def _position(self, position):
+        return tuple(round(coordinate * self.scale) for coordinate in position)
+
+    def _render(self, base_findings, base_p_inv, mid_findings, mid_p_inv, apex_findings, apex_p_inv,
+                base_findings_r, base_p_inv_r, mid_findings_r, mid_p_inv_r, apex_findings_r, apex_p_inv_r):
+        """
+        Render the diagram for the findings and % core involvement of the six biopsy sites.
+
+        The returned image is shared by every caller with the same inputs and must not be modified.
+        """
+        sites = [(base_findings, base_p_inv), (mid_findings, mid_p_inv), (apex_findings, apex_p_inv),
+                 (base_findings_r, base_p_inv_r), (mid_findings_r, mid_p_inv_r), (apex_findings_r, apex_p_inv_r)]
+
+        image = self.base.copy()
+        for (site, mirrored, position, _), (findings, _) in zip(self.sites, sites):
+            overlay = self.overlays.get((site, mirrored, findings))
+            if overlay is not None:
+                image.paste(overlay, position, mask=overlay)
+
+        draw = ImageDraw.Draw(image)
+        for (_, _, _, position), (findings, p_inv) in zip(self.sites, sites):
+            draw.text(position, caption(findings, p_inv), fill="black", font=self.font, align="center")
+        return image
+
+    def _render_encoded(self, *site_inputs, format=DISPLAY_FORMAT, quality=DISPLAY_QUALITY):
+        """Render the diagram for the 12 site inputs and encode it, see encode."""
+        return encode(self.render(*site_inputs), format, quality)
+
+
+def encode(image, format=DISPLAY_FORMAT, quality=DISPLAY_QUALITY):
+    """Encode a diagram to PNG, WEBP or JPEG bytes. quality is ignored for PNG."""
+    format = format.upper()
+    if format == 'JPG':
+        format = 'JPEG'
+    if format not in FORMATS:
+        raise ValueError("Unsupported diagram format: {}".format(format))
+    if format == 'JPEG':
+        # JPEG has no alpha channel, so flatten the diagram onto a white background
+        background = PIL.Image.new('RGBA', image.size, 'white')
+        image = PIL.Image.alpha_composite(background, image).convert('RGB')
+
+    buffer = io.BytesIO()
+    if format == 'PNG':
+        image.save(buffer, format=format, optimize=True)
+    else:
+        image.save(buffer, format=format, quality=quality)
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def default_renderer(width=None):
+    """Return the process-wide renderer of the bundled images at the given width."""
+    return DiagramRenderer(width=width)
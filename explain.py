@@ -0,0 +1,65 @@
+"""
+Per-lobe feature attributions for SEPERA.
+
+Explains the probability of side-specific extraprostatic extension of each lobe with SHAP tree explainers. The model
+is a calibrated ensemble of XGBoost boosters, so one explainer is built per booster and their SHAP values (in log-odds)
+are averaged: the attributions of a lobe add up to the average booster log-odds minus the average expected value.
+Positive values push the lobe towards extraprostatic extension.
+
+Explainers are slow to build, so a LobeExplainer is built once per process (see resources.py) and its attributions
+are cached by feature vector.
+"""
+
+import numpy as np
+
+from features import FEATURES
+from inference import PredictionCache, feature_key
+
+
+class LobeExplainer:
+    """SHAP tree explainers over the boosters of the SEPERA model, with an LRU cache of attributions."""
+
+    def __init__(self, model, cache_size=4096):
+        import shap
+        from artifacts import boosters
+        members, self.missing = boosters(model)
+        self.explainers = [shap.TreeExplainer(booster) for booster in members]
+        # XGBoost explainers only report their expected value (the bias term) once they explained a row
+        self.shap_values(np.full((1, len(FEATURES)), np.nan))
+        self.expected_value = float(np.mean([explainer.expected_value for explainer in self.explainers]))
+        self.cache = PredictionCache(cache_size)
+
+    def shap_values(self, features):
+        """Return the averaged SHAP values of a feature matrix, without the cache."""
+        features = np.array(features, dtype=float)
+        # The explainers treat NaN, not the model's missing value, as missing
+        features[features == self.missing] = np.nan
+        return np.mean([explainer.shap_values(features) for explainer in self.explainers], axis=0)
+
+    def explain(self, features, cache=True):
+        """
+        Return the SHAP values of every row of a feature matrix, as an N x len(FEATURES) array.
+
+        Rows found in the cache are not explained again, and the remaining distinct rows are explained in one batch.
+        Pass cache=False for large batches that would only churn the cache.
+        """
+        features = np.atleast_2d(features)
+        if not cache:
+            return self.shap_values(features)
+
+        values = np.empty((len(features), len(FEATURES)))
+        pending = {}
+        for i, row in enumerate(features):
+            key = feature_key(row)
+            cached = None if key in pending else self.cache.get(key)
+            if cached is None:
+                pending.setdefault(key, []).append(i)
+            else:
+                values[i] = cached
+
+        if pending:
+            first_rows = [rows[0] for rows in pending.values()]
+            for (key, rows), row_values in zip(pending.items(), self.shap_values(features[first_rows])):
+                values[rows] = row_values
+                self.cache.put(key, row_values)
+        return values
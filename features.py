@@ -0,0 +1,140 @@
+"""
+Feature construction for SEPERA.
+
+Turns the raw biopsy inputs collected by the SEPERA form into the 11 model features used for the left and right
+prostatic lobe.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Raw inputs, named after the form variables in page_sepera
+GENERAL_INPUTS = ['age', 'psa', 'vol', 'p_high', 'perineural_inv']
+LEFT_INPUTS = ['base_findings', 'base_p_inv', 'mid_findings', 'mid_p_inv', 'apex_findings', 'apex_p_inv',
+               'pos_core', 'taken_core']
+RIGHT_INPUTS = [name + '_r' for name in LEFT_INPUTS]
+INPUTS = GENERAL_INPUTS + LEFT_INPUTS + RIGHT_INPUTS
+
+# Model features, in the order the model was trained on
+FEATURES = ['Age at Biopsy',
+            'Worst Gleason Grade Group',
+            'PSA density',
+            'Perineural invasion',
+            '% positive cores',
+            '% Gleason pattern 4/5',
+            'Max % core involvement',
+            'Base finding',
+            'Base % core involvement',
+            'Mid % core involvement',
+            'Apex % core involvement']
+
+# Lowest and highest value of each raw input and whether it must be a whole number, as allowed by the form's widgets
+INPUT_RANGES = {'age': (-1, 100, True), 'psa': (-1, 200, False), 'vol': (-1, 300, False), 'p_high': (-1, 100, False),
+                'perineural_inv': (-1, 1, True)}
+for _suffix in ['', '_r']:
+    for _site in ['base', 'mid', 'apex']:
+        INPUT_RANGES[_site + '_findings' + _suffix] = (-1, 5, True)
+        INPUT_RANGES[_site + '_p_inv' + _suffix] = (-1, 100, False)
+    INPUT_RANGES['pos_core' + _suffix] = (-1, 30, True)
+    INPUT_RANGES['taken_core' + _suffix] = (-1, 30, True)
+
+# Input validation messages, in the order the form checks them
+NORMAL_ERROR = "Error: Please ensure % core involvement is set to 0 if the biopsy cores at that site are Normal."
+UNKNOWN_ERROR = "Error: Please ensure % core involvement is set to -1 if the biopsy cores at that site are Unknown."
+CORES_ERROR = "Error: The number of positive cores should be equal or less than the number of cores taken."
+# PSA density is PSA / prostate volume, so a volume of 0 would give an infinite density
+VOLUME_ERROR = "Error: Please ensure prostate volume is greater than 0, or set it to -1 if it is unknown."
+
+
+# Column positions of the per-lobe inputs within a block of LEFT_INPUTS or RIGHT_INPUTS
+_FINDINGS = [0, 2, 4]
+_P_INV = [1, 3, 5]
+_POS_CORE, _TAKEN_CORE = 6, 7
+
+
+def input_matrix(inputs):
+    """Convert a frame (or a sequence of rows) of raw inputs into an N x 21 float array in INPUTS order."""
+    if isinstance(inputs, pd.DataFrame):
+        missing = [name for name in INPUTS if name not in inputs.columns]
+        if missing:
+            raise ValueError("Missing input columns: {}".format(', '.join(missing)))
+        return inputs[INPUTS].to_numpy(dtype=float)
+    return np.atleast_2d(np.asarray(inputs, dtype=float))
+
+
+def build_features(inputs):
+    """
+    Build the model features for both lobes of every patient.
+
+    inputs is an N x 21 array of raw inputs in INPUTS order. Returns a 2N x 11 array in FEATURES order: the N left
+    lobes followed by the N right lobes.
+    """
+    n = len(inputs)
+    general = inputs[:, :len(GENERAL_INPUTS)]
+    lobes = np.concatenate([inputs[:, len(GENERAL_INPUTS):len(GENERAL_INPUTS) + len(LEFT_INPUTS)],
+                            inputs[:, len(GENERAL_INPUTS) + len(LEFT_INPUTS):]])
+    findings = lobes[:, _FINDINGS]
+    p_inv = lobes[:, _P_INV]
+
+    features = np.empty((2 * n, len(FEATURES)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features[:n, 2] = general[:, 1] / general[:, 2]
+        features[:, 4] = lobes[:, _POS_CORE] / lobes[:, _TAKEN_CORE] * 100
+    features[n:, 2] = features[:n, 2]
+    for column, values in [(0, general[:, 0]), (3, general[:, 4]), (5, general[:, 3])]:
+        features[:n, column] = values
+        features[n:, column] = values
+    features[:, 1] = findings.max(axis=1)
+    features[:, 6] = p_inv.max(axis=1)
+    features[:, 7] = findings[:, 0]
+    features[:, 8:11] = p_inv
+    return features
+
+
+def range_errors(inputs):
+    """
+    Check an N x 21 array of raw inputs against INPUT_RANGES, the values the form's widgets accept.
+
+    Returns an object array holding the first error message of each patient with an input out of range (or NaN), or
+    None for the other patients. The form enforces these ranges itself, so this is for inputs that bypass it.
+    """
+    errors = np.full(len(inputs), None, dtype=object)
+    # Assign in reverse order so the first failing input wins
+    for column, name in reversed(list(enumerate(INPUTS))):
+        low, high, integer = INPUT_RANGES[name]
+        values = inputs[:, column]
+        invalid = ~((values >= low) & (values <= high))
+        if integer:
+            invalid |= values != np.round(values)
+        errors[invalid] = "Error: {} must be a {} between {} and {}.".format(
+            name, 'whole number' if integer else 'number', low, high)
+    return errors
+
+
+def validation_errors(inputs):
+    """
+    Apply the form's input validation rules to an N x 21 array of raw inputs.
+
+    Returns an object array holding the first error message of each invalid patient, or None for valid patients.
+    """
+    n_general = len(GENERAL_INPUTS)
+    left = inputs[:, n_general:n_general + len(LEFT_INPUTS)]
+    right = inputs[:, n_general + len(LEFT_INPUTS):]
+    normal = np.zeros(len(inputs), dtype=bool)
+    unknown = np.zeros(len(inputs), dtype=bool)
+    cores = np.zeros(len(inputs), dtype=bool)
+    volume = inputs[:, GENERAL_INPUTS.index('vol')] == 0
+    for lobe in [left, right]:
+        findings = lobe[:, _FINDINGS]
+        p_inv = lobe[:, _P_INV]
+        normal |= ((findings == 0) & (p_inv != 0)).any(axis=1)
+        unknown |= ((findings == -1) & (p_inv != -1)).any(axis=1)
+        cores |= lobe[:, _POS_CORE] > lobe[:, _TAKEN_CORE]
+
+    # Assign in reverse order so the first failing rule wins, as in the form
+    errors = np.full(len(inputs), None, dtype=object)
+    errors[volume] = VOLUME_ERROR
+    errors[cores] = CORES_ERROR
+    errors[unknown] = UNKNOWN_ERROR
+    errors[normal] = NORMAL_ERROR
+    return errors
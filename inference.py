@@ -0,0 +1,124 @@
+"""
+Model inference for SEPERA.
+
+Scores lobe feature rows with the trained model through an in-process LRU cache, so repeated or mirrored disease
+profiles (and identical left and right lobes) do not pay for another model call.
+"""
+
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+# Number of decimals feature values are rounded to when building cache keys
+DECIMALS = 6
+
+
+class PredictionCache:
+    """Thread-safe LRU cache of ssEPE probabilities keyed on the rounded feature vector."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the hit and miss counters along with the current and maximum size."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# Process-wide cache shared by every session
+PREDICTION_CACHE = PredictionCache()
+
+
+@metrics.register_collector
+def _cache_metrics():
+    stats = PREDICTION_CACHE.stats()
+    return [('prediction_cache_hits_total', 'counter', stats['hits']),
+            ('prediction_cache_misses_total', 'counter', stats['misses']),
+            ('prediction_cache_size', 'gauge', stats['size'])]
+
+
+# Number of each model object scored through a cache. Unlike id(), a number is never given to another model once the
+# model is freed (e.g. after a reload), so a new model cannot be served the probabilities of an old one.
+_model_numbers = weakref.WeakKeyDictionary()
+_next_number = itertools.count()
+_numbers_lock = threading.Lock()
+
+
+def feature_key(row):
+    """Return the cache key of a feature row: its values rounded to DECIMALS, with None for NaN."""
+    # NaN never compares equal to itself, so it would make every key unique
+    return tuple(None if value != value else value for value in np.round(row, DECIMALS).tolist())
+
+
+def _key(model, row):
+    with _numbers_lock:
+        number = _model_numbers.get(model)
+        if number is None:
+            number = _model_numbers[model] = next(_next_number)
+    return (number,) + feature_key(row)
+
+
+def predict(model, features, cache=PREDICTION_CACHE):
+    """
+    Return the probability of side-specific extraprostatic extension for every row of a feature matrix.
+
+    Rows found in the cache are not scored again. The remaining rows are deduplicated and scored with a single
+    predict_proba call. Pass cache=None to bypass the cache.
+    """
+    features = np.atleast_2d(features)
+    if cache is None:
+        return model.predict_proba(features)[:, 1]
+
+    prob = np.empty(len(features))
+    pending = OrderedDict()
+    for i, row in enumerate(features):
+        key = _key(model, row)
+        if key in pending:
+            pending[key].append(i)
+            continue
+        value = cache.get(key)
+        if value is None:
+            pending.setdefault(key, []).append(i)
+        else:
+            prob[i] = value
+
+    if pending:
+        first_rows = [rows[0] for rows in pending.values()]
+        new_prob = model.predict_proba(features[first_rows])[:, 1]
+        for (key, rows), value in zip(pending.items(), new_prob):
+            prob[rows] = value
+            cache.put(key, float(value))
+    return prob
@@ -0,0 +1,112 @@
+"""
+Uncertainty of the similar case rates of SEPERA.
+
+The similar case finder reports X out of Y similar patients with extraprostatic extension, and Y is often small. This
+module adds confidence intervals for the rate X / Y: Wilson score intervals (closed form, cheap enough for every
+request) and percentile bootstrap intervals (binomial resampling, vectorized in blocks and optionally spread over a
+process pool for batch runs). Tolerance-sensitivity bands show how the rate moves when the similarity tolerances are
+narrowed or widened.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from similar import TOLERANCES, Tolerances
+
+# Normal quantile of a two-sided 95% interval
+Z = 1.959963984540054
+ALPHA = 0.05
+
+RESAMPLES = 2000
+# Upper bound on the number of resampled rates held in memory at once
+BLOCK_SIZE = 1 << 22
+
+# Multipliers of the similarity tolerances used for the sensitivity bands
+SCALES = (0.5, 1.0, 1.5, 2.0)
+
+
+def wilson(pos, total, z=Z):
+    """Return the lower and upper bounds of the Wilson score interval of pos / total, NaN where total is 0."""
+    pos = np.asarray(pos, dtype=float)
+    total = np.asarray(total, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = pos / total
+        center = (rate + z ** 2 / (2 * total)) / (1 + z ** 2 / total)
+        half_width = z / (1 + z ** 2 / total) * np.sqrt(rate * (1 - rate) / total + z ** 2 / (4 * total ** 2))
+    return center - half_width, center + half_width
+
+
+def bootstrap(pos, total, resamples=RESAMPLES, alpha=ALPHA, seed=None):
+    """
+    Return the lower and upper bounds of the percentile bootstrap interval of pos / total, NaN where total is 0.
+
+    Resampling the similar cases of a lobe with replacement amounts to drawing the number of cases with extraprostatic
+    extension from Binomial(total, pos / total), so all rows are resampled at once without materializing the cases.
+    With a rate of 0 or 1 every resample is identical and the interval collapses to a point, so prefer wilson for small
+    or extreme counts.
+    """
+    pos = np.atleast_1d(np.asarray(pos, dtype=float))
+    total = np.atleast_1d(np.asarray(total, dtype=np.int64))
+    rng = np.random.default_rng(seed)
+    lower = np.full(len(pos), np.nan)
+    upper = np.full(len(pos), np.nan)
+
+    rows = np.flatnonzero(total > 0)
+    block = max(1, BLOCK_SIZE // resamples)
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start + block]
+        n = total[chunk, None]
+        rates = rng.binomial(n, pos[chunk, None] / n, size=(len(chunk), resamples)) / n
+        lower[chunk], upper[chunk] = np.quantile(rates, [alpha / 2, 1 - alpha / 2], axis=1)
+    return lower, upper
+
+
+def _bootstrap_task(args):
+    return bootstrap(*args)
+
+
+def bootstrap_parallel(pos, total, resamples=RESAMPLES, alpha=ALPHA, seed=None, workers=None, executor=None):
+    """
+    Same as bootstrap, with the rows split over workers processes, each with an independent stream.
+
+    Pass a ProcessPoolExecutor to reuse its processes across calls, e.g. for every chunk of a batch run. Otherwise a
+    pool is started and shut down for this call.
+    """
+    pos = np.atleast_1d(np.asarray(pos, dtype=float))
+    total = np.atleast_1d(np.asarray(total, dtype=np.int64))
+    workers = workers or os.cpu_count()
+    splits = np.array_split(np.arange(len(pos)), workers)
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    tasks = [(pos[split], total[split], resamples, alpha, split_seed) for split, split_seed in zip(splits, seeds)]
+    if executor is None:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_bootstrap_task, tasks))
+    else:
+        results = list(executor.map(_bootstrap_task, tasks))
+    return np.concatenate([lower for lower, _ in results]), np.concatenate([upper for _, upper in results])
+
+
+def scale_tolerances(scale, tolerances=TOLERANCES):
+    """Return the similarity tolerances narrowed (scale < 1) or widened (scale > 1) by a factor."""
+    low_psa, high_psa = tolerances.psa_density
+    return Tolerances(age=tolerances.age * scale,
+                      psa_density=(1 - (1 - low_psa) * scale, 1 + (high_psa - 1) * scale),
+                      percent=tolerances.percent * scale)
+
+
+def tolerance_bands(index, rows, scales=SCALES, tolerances=TOLERANCES):
+    """
+    Re-run the similar case query of feature rows at several tolerance widths.
+
+    Returns the lowest and highest similar case rate over the widths, and the len(scales) x N matrix of rates (NaN
+    where no similar case was found).
+    """
+    rates = np.empty((len(scales), len(np.atleast_2d(rows))))
+    for i, scale in enumerate(scales):
+        pos, total = index.query_batch(rows, scale_tolerances(scale, tolerances))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates[i] = pos / total
+    # fmin and fmax ignore NaN rates
+    return np.fmin.reduce(rates, axis=0), np.fmax.reduce(rates, axis=0), rates
@@ -0,0 +1,188 @@
+"""
+Lightweight metrics for SEPERA.
+
+Times the stages of a submit and the loading of shared resources with spans, and counts events such as validation
+rejections. Metrics are exported in the Prometheus text format over HTTP (GET /metrics) or to a local file that is
+rewritten periodically.
+
+Metrics are off unless SEPERA_METRICS=1. When they are off, span() returns a shared no-op context manager and
+increment() returns immediately, so instrumented code pays almost nothing. The exporters are configured with
+SEPERA_METRICS_PORT and SEPERA_METRICS_FILE (rewritten every SEPERA_METRICS_INTERVAL seconds, 15 by default).
+"""
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('SEPERA_METRICS', '0').lower() not in ('', '0', 'false')
+PREFIX = 'sepera_'
+INTERVAL = 15
+
+# Upper bounds (in seconds) of the span duration histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Cumulative histogram of durations, with their count and sum."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+_lock = threading.Lock()
+COUNTERS = {}
+SPANS = {}
+# Callables returning (name, type, value) samples read at export time, e.g. the hit counters of the caches
+COLLECTORS = []
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def span(name):
+    """Return a context manager that records the duration of its block under name."""
+    return _Span(name) if ENABLED else _NULL_SPAN
+
+
+def observe(name, seconds):
+    """Record a duration under the span name."""
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = SPANS.get(name)
+        if histogram is None:
+            histogram = SPANS[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name, value=1):
+    """Add value to a counter. Counter names end in _total by convention."""
+    if not ENABLED:
+        return
+    with _lock:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def register_collector(collector):
+    """Register a callable returning (name, type, value) samples to export along with the counters and spans."""
+    COLLECTORS.append(collector)
+    return collector
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    with _lock:
+        COUNTERS.clear()
+        SPANS.clear()
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(COUNTERS)
+        spans = {name: (list(histogram.counts), histogram.count, histogram.sum) for name, histogram in SPANS.items()}
+
+    lines = []
+    for name, value in sorted(counters.items()):
+        lines += ['# TYPE {}{} counter'.format(PREFIX, name), '{}{} {}'.format(PREFIX, name, value)]
+    for collector in COLLECTORS:
+        for name, kind, value in collector():
+            lines += ['# TYPE {}{} {}'.format(PREFIX, name, kind), '{}{} {}'.format(PREFIX, name, value)]
+
+    if spans:
+        name = PREFIX + 'span_seconds'
+        lines.append('# TYPE {} histogram'.format(name))
+        for span_name, (counts, count, total) in sorted(spans.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{span="{}",le="{}"}} {}'.format(name, span_name, bound, cumulative))
+            lines.append('{}_sum{{span="{}"}} {}'.format(name, span_name, total))
+            lines.append('{}_count{{span="{}"}} {}'.format(name, span_name, count))
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """Write the metrics to a file, atomically replacing the previous version."""
+    partial = '{}.tmp'.format(path)
+    with open(partial, 'w') as file:
+        file.write(render())
+    os.replace(partial, path)
+
+
+def _serve(port):
+    """Serve the metrics at /metrics in a background thread."""
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+
+
+_started = False
+
+
+def start(port=None, path=None, interval=None):
+    """
+    Start the exporters once per process: an HTTP endpoint on port and a file writer to path, by default taken from
+    SEPERA_METRICS_PORT and SEPERA_METRICS_FILE. Does nothing when metrics are disabled.
+    """
+    global _started
+    with _lock:
+        if _started or not ENABLED:
+            return
+        _started = True
+
+    port = port or os.environ.get('SEPERA_METRICS_PORT')
+    path = path or os.environ.get('SEPERA_METRICS_FILE')
+    interval = interval or float(os.environ.get('SEPERA_METRICS_INTERVAL', INTERVAL))
+    if port:
+        _serve(int(port))
+    if path:
+        def write_periodically():
+            while True:
+                write(path)
+                time.sleep(interval)
+        threading.Thread(target=write_periodically, name='metrics-file', daemon=True).start()
@@ -16,8 +16,9 @@ def persist(key: str) -> str:
 def load_widget_state():
     """Load persistent widget state."""
     if _PERSIST_STATE_KEY in _state:
+        # Only visit the persisted keys, not the whole session state
         _state.update({
-            key: value
-            for key, value in _state.items()
-            if key in _state[_PERSIST_STATE_KEY]
+            key: _state[key]
+            for key in _state[_PERSIST_STATE_KEY]
+            if key in _state
         })
@@ -0,0 +1,303 @@
+"""
+Offline-first provisioning of the SEPERA model and reference cohort.
+
+Artifacts are looked up in a local store directory first and otherwise fetched from a chain of providers: a local
+directory, the model bundled in Model/SEPERA.zip, a URL (resumable HTTP downloads) and Google Drive. Every artifact
+with a known checksum in Model/manifest.json is verified before use, and missing artifacts are fetched concurrently.
+The manifest has no checksum for data.pkl yet, so the reference cohort is not verified.
+
+Providers write to a temporary file next to the destination and move it into place once complete, so other threads
+and processes sharing the store never see a partly written artifact.
+
+Fill the store at image-build time so that no request ever waits for a download:
+    python provision.py prewarm --store model --url https://example.org/sepera
+
+Serve a directory of artifacts locally (with HTTP range support) to stand in for a remote host:
+    python provision.py serve artifacts --port 8000
+"""
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+MANIFEST = Path('Model/manifest.json')
+BUNDLED_MODEL = Path('Model/SEPERA.zip')
+ARTIFACTS = ['SEPERA.pkl', 'data.pkl']
+CHUNK = 1 << 20
+
+
+class ProvisioningError(Exception):
+    """Raised when an artifact cannot be obtained from any provider."""
+
+
+def sha256(path):
+    """Return the hex SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(CHUNK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _replacing(dest):
+    """Yield a temporary path next to dest, moved over dest if the block completes and removed otherwise."""
+    partial = Path('{}.{}-{}.tmp'.format(dest, os.getpid(), threading.get_ident()))
+    try:
+        yield partial
+        os.replace(partial, dest)
+    finally:
+        if partial.exists():
+            partial.unlink()
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Hold an exclusive lock on the file at path (created if needed), shared with other threads and processes."""
+    try:
+        import fcntl
+    except ImportError:
+        # No fcntl on Windows: callers fall back to files of their own
+        yield False
+        return
+    with open(path, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class LocalProvider:
+    """Copies artifacts from a local directory."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def fetch(self, name, dest):
+        source = self.directory / name
+        if not source.exists():
+            return False
+        with _replacing(dest) as partial:
+            shutil.copyfile(source, partial)
+        return True
+
+
+class BundledProvider:
+    """Extracts artifacts from a zip archive, by default the model bundled with the repository."""
+
+    def __init__(self, archive=BUNDLED_MODEL):
+        self.archive = Path(archive)
+
+    def fetch(self, name, dest):
+        if not self.archive.exists():
+            return False
+        with zipfile.ZipFile(self.archive) as archive:
+            if name not in archive.namelist():
+                return False
+            with _replacing(dest) as partial, archive.open(name) as source, open(partial, 'wb') as file:
+                shutil.copyfileobj(source, file, CHUNK)
+        return True
+
+
+class URLProvider:
+    """
+    Downloads artifacts from base_url/<name>.
+
+    Partial downloads are kept next to the destination and resumed with an HTTP range request. Servers that ignore
+    the range restart the download from scratch. A lock file serializes the downloads of an artifact, so that processes
+    sharing the store never append to the same partial download at once.
+    """
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, name, dest):
+        existed = Path(dest).exists()
+        with _locked(str(dest) + '.lock') as locked:
+            if not existed and Path(dest).exists():
+                # Another process downloaded it while this one waited for the lock
+                return True
+            partial = Path(str(dest) + ('.part' if locked else '.{}.part'.format(os.getpid())))
+            return self._download(name, dest, partial)
+
+    def _download(self, name, dest, partial):
+        offset = partial.stat().st_size if partial.exists() else 0
+        request = urllib.request.Request('{}/{}'.format(self.base_url, name))
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                mode = 'ab' if offset and response.status == 206 else 'wb'
+                with open(partial, mode) as file:
+                    shutil.copyfileobj(response, file, CHUNK)
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                return False
+            if error.code != 416 or not offset:
+                raise
+            # The partial download was already complete
+        os.replace(partial, dest)
+        return True
+
+
+class GoogleDriveProvider:
+    """Downloads artifacts from Google Drive, given the file id of each artifact."""
+
+    def __init__(self, file_ids):
+        self.file_ids = file_ids
+
+    def fetch(self, name, dest):
+        if name not in self.file_ids:
+            return False
+        from google_drive_downloader import GoogleDriveDownloader as gdd
+        with _replacing(dest) as partial:
+            gdd.download_file_from_google_drive(self.file_ids[name], str(partial))
+        return True
+
+
+class ArtifactStore:
+    """
+    Local directory of verified artifacts, filled on demand from a chain of providers.
+
+    checksums maps artifact names to their expected SHA-256 digest. Artifacts without a checksum are not verified.
+    """
+
+    def __init__(self, directory, providers, checksums=None):
+        self.directory = Path(directory)
+        self.providers = providers
+        self.checksums = checksums or {}
+
+    def path(self, name):
+        return self.directory / name
+
+    def verify(self, name):
+        """Return whether the stored copy of an artifact exists and matches its checksum."""
+        path = self.path(name)
+        if not path.exists():
+            return False
+        expected = self.checksums.get(name)
+        return expected is None or sha256(path) == expected
+
+    def missing(self, names=ARTIFACTS):
+        """Return the artifacts that are not in the store (or fail their checksum)."""
+        return [name for name in names if not self.verify(name)]
+
+    def fetch(self, name):
+        """Return the path of a verified artifact, trying each provider in turn if it is not in the store yet."""
+        if self.verify(name):
+            return self.path(name)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        errors = []
+        for provider in self.providers:
+            try:
+                if not provider.fetch(name, self.path(name)):
+                    continue
+            except (OSError, http.client.HTTPException) as error:
+                errors.append('{}: {}'.format(type(provider).__name__, error))
+                continue
+            if self.verify(name):
+                return self.path(name)
+            errors.append('{}: checksum mismatch'.format(type(provider).__name__))
+            self.path(name).unlink()
+        raise ProvisioningError("Could not provision {} ({})".format(name, '; '.join(errors) or 'no provider has it'))
+
+    def fetch_all(self, names=ARTIFACTS, max_workers=4):
+        """Fetch several artifacts concurrently and return their paths in the same order."""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.fetch, names))
+
+
+def load_checksums(manifest=MANIFEST):
+    """Read the expected checksums of the artifacts from the manifest, if there is one."""
+    manifest = Path(manifest)
+    if not manifest.exists():
+        return {}
+    return {name: entry.get('sha256') for name, entry in json.loads(manifest.read_text()).items()}
+
+
+def default_store(directory='model', drive_ids=None):
+    """
+    Return the store used by the app: a local directory (SEPERA_ARTIFACT_DIR), the bundled model, a URL
+    (SEPERA_ARTIFACT_URL) and finally Google Drive, in that order.
+    """
+    providers = []
+    if os.environ.get('SEPERA_ARTIFACT_DIR'):
+        providers.append(LocalProvider(os.environ['SEPERA_ARTIFACT_DIR']))
+    providers.append(BundledProvider())
+    if os.environ.get('SEPERA_ARTIFACT_URL'):
+        providers.append(URLProvider(os.environ['SEPERA_ARTIFACT_URL']))
+    if drive_ids:
+        providers.append(GoogleDriveProvider(drive_ids))
+    return ArtifactStore(directory, providers, load_checksums())
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that also answers 'Range: bytes=N-' requests, so resumed downloads can be tested."""
+
+    def send_head(self):
+        range_header = self.headers.get('Range', '')
+        path = Path(self.translate_path(self.path))
+        if not range_header.startswith('bytes=') or not path.is_file():
+            return super().send_head()
+        start = int(range_header[len('bytes='):].split('-')[0] or 0)
+        size = path.stat().st_size
+        file = open(path, 'rb')
+        file.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(str(path)))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision the SEPERA model and reference cohort.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    prewarm = commands.add_parser('prewarm', help="Fill the local artifact store")
+    prewarm.add_argument('--store', default='model', help="Directory of the artifact store")
+    prewarm.add_argument('--dir', help="Local directory to copy artifacts from")
+    prewarm.add_argument('--url', help="Base URL to download artifacts from")
+    prewarm.add_argument('--drive', nargs=2, metavar=('MODEL_ID', 'DATA_ID'), help="Google Drive file ids")
+
+    serve = commands.add_parser('serve', help="Serve a directory of artifacts over HTTP")
+    serve.add_argument('directory', help="Directory to serve")
+    serve.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        handler = functools.partial(RangeRequestHandler, directory=args.directory)
+        http.server.ThreadingHTTPServer(('', args.port), handler).serve_forever()
+        return
+
+    providers = []
+    if args.dir:
+        providers.append(LocalProvider(args.dir))
+    providers.append(BundledProvider())
+    if args.url:
+        providers.append(URLProvider(args.url))
+    if args.drive:
+        providers.append(GoogleDriveProvider(dict(zip(ARTIFACTS, args.drive))))
+    store = ArtifactStore(args.store, providers, load_checksums())
+    for path in store.fetch_all():
+        print("Provisioned {}".format(path))
+
+
+if __name__ == "__main__":
+    main()
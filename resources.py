@@ -0,0 +1,272 @@
+"""
+Process-wide shared resources for SEPERA.
+
+The model, reference cohort, similar case index, explainer and diagram renderer are loaded once per process and shared
+by every Streamlit session. Loading is thread-safe: concurrent sessions asking for a resource that is not loaded yet wait
+for a single load. Each resource carries a version key, and a resource is reloaded when its version changes. Versions
+that are computed (from the manifest and the artifacts' modification times) are checked at most every VERSION_TTL
+seconds, so a rerun does not re-read them. prewarm loads the resources in a background thread ahead of the first
+submit.
+"""
+
+import threading
+import time
+from pathlib import Path
+
+import metrics
+
+# Settings used by the loaders, see configure
+SETTINGS = {'store': 'model', 'drive_ids': {}}
+
+# Seconds for which a computed version is trusted before it is computed again
+VERSION_TTL = 5.0
+# Seconds before a background load that failed is tried again at the same version
+RETRY_AFTER = 300.0
+
+
+class Resource:
+    """A lazily loaded, shared resource with a version key."""
+
+    def __init__(self, name, loader, version):
+        self.name = name
+        self.loader = loader
+        self.version = version
+        self.value = None
+        self.loaded_version = None
+        self.lock = threading.Lock()
+        self.checked_version = None
+        self.checked_at = None
+        self.failed_version = None
+        self.failed_at = None
+
+    def current_version(self):
+        if not callable(self.version):
+            return self.version
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at > VERSION_TTL:
+            self.checked_version = self.version()
+            self.checked_at = now
+        return self.checked_version
+
+    def loaded(self):
+        return self.loaded_version is not None and self.loaded_version == self.current_version()
+
+    def get(self):
+        version = self.current_version()
+        if self.loaded_version != version:
+            with self.lock:
+                if self.loaded_version != version:
+                    try:
+                        with metrics.span('load_' + self.name):
+                            self.value = self.loader()
+                    except Exception:
+                        self.failed_version, self.failed_at = version, time.monotonic()
+                        metrics.increment('load_errors_total')
+                        raise
+                    self.loaded_version = version
+        return self.value
+
+    def failed_recently(self):
+        """Return whether loading failed at the current version less than RETRY_AFTER seconds ago."""
+        return (self.failed_at is not None and self.failed_version == self.current_version()
+                and time.monotonic() - self.failed_at < RETRY_AFTER)
+
+    def invalidate(self):
+        with self.lock:
+            self.value = None
+            self.loaded_version = None
+            self.checked_at = None
+            self.failed_at = None
+
+
+REGISTRY = {}
+
+
+def register(name, version='1'):
+    """Register the decorated function as the loader of a resource. version may be a string or a callable."""
+    def decorator(loader):
+        REGISTRY[name] = Resource(name, loader, version)
+        return loader
+    return decorator
+
+
+def get(name):
+    """Return a resource, loading it on first use or when its version changed."""
+    return REGISTRY[name].get()
+
+
+def loaded(name):
+    """Return whether a resource is loaded at its current version."""
+    return REGISTRY[name].loaded()
+
+
+def version(name):
+    """Return the version of a resource that is loaded, or None."""
+    return REGISTRY[name].loaded_version
+
+
+def invalidate(name=None):
+    """Drop one resource, or all of them, so that the next get checks its version again and reloads it."""
+    for resource in ([REGISTRY[name]] if name else REGISTRY.values()):
+        resource.invalidate()
+
+
+@metrics.register_collector
+def _cache_metrics():
+    """Hit counters of the caches held by the shared resources that are loaded."""
+    samples = []
+    explainer = REGISTRY['explainer'].value
+    if explainer is not None:
+        stats = explainer.cache.stats()
+        samples += [('explanation_cache_hits_total', 'counter', stats['hits']),
+                    ('explanation_cache_misses_total', 'counter', stats['misses'])]
+    renderer = REGISTRY['renderer'].value
+    if renderer is not None:
+        info = renderer.render_encoded.cache_info()
+        samples += [('diagram_cache_hits_total', 'counter', info.hits),
+                    ('diagram_cache_misses_total', 'counter', info.misses)]
+    return samples
+
+
+def configure(**settings):
+    """Update the loader settings (store directory, Google Drive ids), dropping resources whose settings changed."""
+    changed = {key for key, value in settings.items() if SETTINGS.get(key) != value}
+    SETTINGS.update(settings)
+    if changed:
+        invalidate('model')
+        invalidate('cohort')
+        invalidate('similar_index')
+        invalidate('explainer')
+
+
+# Fast formats of each provisioned pickle, in order of preference (see artifacts.py and trees.py)
+FAST_FORMATS = {'SEPERA.pkl': ['SEPERA.npz', 'SEPERA'], 'data.pkl': ['data.npy']}
+
+
+def _fast(name):
+    """Return the path of the preferred fast format of an artifact in the store, or None."""
+    for fast in FAST_FORMATS[name]:
+        if Path(SETTINGS['store'], fast).exists():
+            return Path(SETTINGS['store'], fast)
+    return None
+
+
+def _store():
+    from provision import default_store
+    return default_store(SETTINGS['store'], SETTINGS['drive_ids'])
+
+
+def _artifact(name):
+    """Return the path of a fast artifact if it exists, or of the provisioned pickle otherwise."""
+    return _fast(name) or _store().fetch(name)
+
+
+def _artifact_version(name):
+    """Version an artifact by its expected checksum and the path and modification time of its fast format."""
+    from provision import load_checksums
+    path = _fast(name)
+    return '{}:{}'.format(load_checksums().get(name), path and (path.name, path.stat().st_mtime))
+
+
+def missing():
+    """Return the artifacts that still need to be provisioned before the model and cohort can load."""
+    from provision import ARTIFACTS
+    return _store().missing([name for name in ARTIFACTS if _fast(name) is None])
+
+
+@register('model', version=lambda: _artifact_version('SEPERA.pkl'))
+def _load_model():
+    from artifacts import load_model
+    return load_model(_artifact('SEPERA.pkl'))
+
+
+@register('cohort', version=lambda: _artifact_version('data.pkl'))
+def _load_cohort():
+    from artifacts import load_cohort
+    return load_cohort(_artifact('data.pkl'))
+
+
+def _index_version():
+    """Version the similar case index by the cohort it indexes and the modification time of its saved copy."""
+    path = Path(SETTINGS['store'], 'similar', 'index.json')
+    return '{}:{}'.format(REGISTRY['cohort'].current_version(), path.exists() and path.stat().st_mtime)
+
+
+@register('similar_index', version=_index_version)
+def _load_similar_index():
+    # The saved index is memory-mapped, so the processes of a host share it
+    from similar import SimilarCaseIndex
+    directory = Path(SETTINGS['store'], 'similar')
+    if (directory / 'index.json').exists():
+        return SimilarCaseIndex.load(directory)
+    return SimilarCaseIndex(get('cohort'))
+
+
+@register('explainer', version=lambda: _artifact_version('SEPERA.pkl'))
+def _load_explainer():
+    # The compiled model has no boosters to explain, so use the native boosters or the pickle
+    from artifacts import load_model
+    from explain import LobeExplainer
+    native = Path(SETTINGS['store'], 'SEPERA')
+    if not native.exists():
+        native = _store().fetch('SEPERA.pkl')
+    return LobeExplainer(load_model(native))
+
+
+@register('audit')
+def _load_audit():
+    from audit import AuditLog
+    return AuditLog.from_env()
+
+
+@register('renderer')
+def _load_renderer():
+    from diagram import DISPLAY_WIDTH, default_renderer
+    return default_renderer(DISPLAY_WIDTH)
+
+
+# Resources loaded by prewarm, in order: the ones every submit needs come first
+PREWARM = ['model', 'cohort', 'similar_index', 'renderer', 'explainer']
+_prewarm_lock = threading.Lock()
+_prewarm_thread = None
+
+
+def prewarm(names=PREWARM):
+    """
+    Load resources in a background thread, once per process, so that the first submit does not wait for them.
+
+    Sessions that need a resource while it is being loaded wait for the same load.
+    """
+    global _prewarm_thread
+
+    def load():
+        for name in names:
+            _load_quietly(name)
+
+    with _prewarm_lock:
+        if _prewarm_thread is None:
+            _prewarm_thread = threading.Thread(target=load, name='prewarm', daemon=True)
+            _prewarm_thread.start()
+    return _prewarm_thread
+
+
+def _load_quietly(name):
+    try:
+        get(name)
+    except Exception:
+        # The error surfaces again when a submit needs the resource
+        pass
+
+
+def load_in_background(name):
+    """
+    Return whether a resource is loaded at its current version. If it is not, and no load is in progress, start loading
+    it in a background thread, so that callers that can do without it do not wait. A load that failed is not tried
+    again for RETRY_AFTER seconds, unless the resource's version changes or it is invalidated.
+    """
+    resource = REGISTRY[name]
+    if resource.loaded():
+        return True
+    if not resource.lock.locked() and not resource.failed_recently():
+        threading.Thread(target=_load_quietly, args=(name,), name='load-' + name, daemon=True).start()
+    return False
@@ -0,0 +1,269 @@
+"""
+Standalone HTTP inference service for SEPERA.
+
+Serves the SEPERA model without the Streamlit UI, for integration with other systems. Requests are coalesced into
+micro-batches: requests arriving within max_wait seconds of each other (up to max_batch_size of them) are scored with
+a single model call and a single similar case query.
+
+POST /predict with a JSON object holding the raw form inputs (see features.INPUTS), e.g.
+    {"age": 72, "psa": 11.0, "vol": 40.0, "p_high": 20.0, "perineural_inv": 1, "base_findings": 3, ...}
+Inputs must lie within the ranges of the form's widgets (see features.INPUT_RANGES). Add "diagram": true to also
+receive the annotated prostate diagram, base64-encoded (in "format": PNG, WEBP or JPEG, default WEBP, with "quality"
+from 1 to 100).
+
+GET /health reports whether the model is loaded, and GET /metrics returns the metrics in the Prometheus text format
+(see metrics.py, enabled with SEPERA_METRICS=1).
+
+Usage:
+    python service.py --port 8080 --max-batch-size 64 --max-wait-ms 5
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+from http import HTTPStatus
+
+import numpy as np
+
+import metrics
+import resources
+from audit import make_record
+from diagram import DISPLAY_FORMAT, DISPLAY_QUALITY, FORMATS
+from features import INPUTS, build_features, range_errors, validation_errors
+from inference import predict
+
+# Raw inputs passed to the diagram renderer, in the order of its arguments
+SITE_INPUTS = ['base_findings', 'base_p_inv', 'mid_findings', 'mid_p_inv', 'apex_findings', 'apex_p_inv',
+               'base_findings_r', 'base_p_inv_r', 'mid_findings_r', 'mid_p_inv_r', 'apex_findings_r', 'apex_p_inv_r']
+
+MAX_BODY = 1 << 16
+
+
+class BadRequest(Exception):
+    """Raised for requests that cannot be scored, with the HTTP status to answer with."""
+
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def score(inputs):
+    """Score an N x 21 matrix of valid raw inputs: probabilities and similar case counts of both lobes."""
+    n = len(inputs)
+    with metrics.span('features'):
+        features = build_features(inputs)
+    with metrics.span('predict'):
+        prob = predict(resources.get('model'), features)
+    with metrics.span('similar_cases'):
+        pos, total = resources.get('similar_index').query_batch(features)
+    metrics.increment('empty_similar_cases_total', int((total == 0).sum()))
+    results = [{'left': {'probability': float(prob[i]), 'pos_ssEPE': int(pos[i]), 'similar_cases': int(total[i])},
+                'right': {'probability': float(prob[n + i]), 'pos_ssEPE': int(pos[n + i]),
+                          'similar_cases': int(total[n + i])}}
+               for i in range(n)]
+
+    # Queue the predictions for the write-behind audit log
+    audit_log = resources.get('audit')
+    if audit_log is not None:
+        model_version = resources.version('model')
+        for row, result in zip(inputs.tolist(), results):
+            audit_log.record(make_record(dict(zip(INPUTS, row)), result, model_version, source='service'))
+    return results
+
+
+class MicroBatcher:
+    """Coalesces concurrent scoring requests into batches scored in a worker thread."""
+
+    def __init__(self, max_batch_size=64, max_wait=0.005):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, row):
+        """Queue one row of raw inputs and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            rows, futures = zip(*batch)
+            try:
+                results = await loop.run_in_executor(None, score, np.array(rows, dtype=float))
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            metrics.increment('batches_total')
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+def parse_inputs(body):
+    """Validate a request body and return its row of raw inputs along with the parsed body."""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise BadRequest("Request body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise BadRequest("Request body must be a JSON object")
+    missing = [name for name in INPUTS if name not in payload]
+    if missing:
+        raise BadRequest("Missing inputs: {}".format(', '.join(missing)))
+    # Only JSON numbers: float() would also accept strings ("3.0") and booleans
+    not_numbers = [name for name in INPUTS
+                   if isinstance(payload[name], bool) or not isinstance(payload[name], (int, float))]
+    if not_numbers:
+        raise BadRequest("Inputs must be numbers: {}".format(', '.join(not_numbers)))
+    row = [float(payload[name]) for name in INPUTS]
+
+    inputs = np.array([row])
+    error = range_errors(inputs)[0] or validation_errors(inputs)[0]
+    if error is not None:
+        metrics.increment('validation_rejections_total')
+        raise BadRequest(error, HTTPStatus.UNPROCESSABLE_ENTITY)
+
+    if payload.get('diagram'):
+        image_format = payload.get('format', DISPLAY_FORMAT)
+        if not isinstance(image_format, str) or image_format.upper() not in FORMATS:
+            raise BadRequest("format must be one of {}".format(', '.join(FORMATS)), HTTPStatus.UNPROCESSABLE_ENTITY)
+        quality = payload.get('quality', DISPLAY_QUALITY)
+        if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+            raise BadRequest("quality must be a whole number between 1 and 100", HTTPStatus.UNPROCESSABLE_ENTITY)
+    return row, payload
+
+
+def render_diagram(row, payload):
+    """Return the base64-encoded diagram of a request, given its validated row of raw inputs."""
+    # Findings are grade codes (validated as whole numbers) and % core involvement is shown as a float, as in the web
+    # app
+    site_inputs = [row[INPUTS.index(name)] if 'p_inv' in name else int(row[INPUTS.index(name)])
+                   for name in SITE_INPUTS]
+    image = resources.get('renderer').render_encoded(*site_inputs,
+                                                     format=payload.get('format', DISPLAY_FORMAT).upper(),
+                                                     quality=payload.get('quality', DISPLAY_QUALITY))
+    return base64.b64encode(image).decode('ascii')
+
+
+class Service:
+    """Minimal asyncio HTTP/1.1 server in front of a MicroBatcher."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self.respond(reader)
+        except BadRequest as error:
+            status, body = error.status, {'error': str(error)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as error:
+            status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(error)}
+
+        if isinstance(body, str):
+            data, content_type = body.encode(), 'text/plain; version=0.0.4'
+        else:
+            data, content_type = json.dumps(body).encode(), 'application/json'
+        writer.write('HTTP/1.1 {} {}\r\n'.format(status.value, status.phrase).encode())
+        writer.write('Content-Type: {}\r\n'.format(content_type).encode())
+        writer.write('Content-Length: {}\r\n'.format(len(data)).encode())
+        writer.write(b'Connection: close\r\n\r\n')
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+
+    async def respond(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise BadRequest("Malformed request line")
+        method, path, _ = request_line
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if path == '/health' and method == 'GET':
+            return HTTPStatus.OK, {'status': 'ok', 'model_loaded': resources.loaded('model'),
+                                   'batches': self.batcher.batches, 'requests': self.batcher.requests}
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, metrics.render()
+        if path != '/predict':
+            raise BadRequest("Not found", HTTPStatus.NOT_FOUND)
+        if method != 'POST':
+            raise BadRequest("Method not allowed", HTTPStatus.METHOD_NOT_ALLOWED)
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest("Invalid Content-Length")
+        if length < 0:
+            raise BadRequest("Invalid Content-Length")
+        if length > MAX_BODY:
+            raise BadRequest("Request body too large", HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        row, payload = parse_inputs(await reader.readexactly(length))
+        metrics.increment('requests_total')
+
+        result = await self.batcher.submit(row)
+        if payload.get('diagram'):
+            loop = asyncio.get_running_loop()
+            result = dict(result, diagram=await loop.run_in_executor(None, render_diagram, row, payload))
+        return HTTPStatus.OK, result
+
+
+async def serve(host='127.0.0.1', port=8080, max_batch_size=64, max_wait=0.005):
+    """Load the shared resources and serve requests until cancelled."""
+    loop = asyncio.get_running_loop()
+    for name in ['model', 'similar_index']:
+        await loop.run_in_executor(None, resources.get, name)
+
+    batcher = MicroBatcher(max_batch_size, max_wait)
+    service = Service(batcher)
+    batching = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(service.handle, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve SEPERA predictions over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--store', default='model', help="Directory of the artifact store")
+    parser.add_argument('--max-batch-size', type=int, default=64, help="Most requests scored in one model call")
+    parser.add_argument('--max-wait-ms', type=float, default=5, help="Longest wait for a batch to fill up")
+    args = parser.parse_args()
+
+    resources.configure(store=args.store)
+    asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Lean per-session state of the SEPERA web app.
+
+A session keeps only the raw form inputs of its last submit and the scalar results computed from them in
+st.session_state, which is a few hundred bytes of plain Python values. The large objects behind a result (model, cohort
+index, diagram overlays and encoded diagrams) are shared by every session of the process. The render results of a
+session (the encoded diagram, feature attributions and what-if curves) are held in a process-wide store that keeps one
+entry per session and evicts sessions idle for longer than IDLE_TIMEOUT seconds, or the least recently seen ones beyond
+MAX_SESSIONS. An evicted session's render results are rebuilt from its raw inputs the next time it reruns.
+"""
+
+import collections
+import threading
+import time
+import uuid
+
+import metrics
+
+STATE_KEY = 'sepera_session'
+# Results of both lobes kept per session
+RESULT_KEYS = ['prob', 'prob_r', 'pos_ssEPE', 'similar_cases', 'pos_ssEPE_r', 'similar_cases_r', 'low', 'high', 'low_r',
+               'high_r']
+IDLE_TIMEOUT = 30 * 60
+MAX_SESSIONS = 1000
+
+# The image is the encoded diagram shared with the renderer's cache, not a copy
+Renders = collections.namedtuple('Renders', ['image', 'attributions', 'curves'])
+
+
+def _plain(value):
+    """Convert NumPy scalars to Python scalars, so that the session state holds no NumPy objects."""
+    return value.item() if hasattr(value, 'item') else value
+
+
+def save(state, inputs, result):
+    """
+    Keep the raw inputs and the RESULT_KEYS of result of a submit in the session state.
+
+    Returns the session's token, which keys its render results in RENDERS.
+    """
+    saved = state.get(STATE_KEY)
+    token = saved['token'] if saved else uuid.uuid4().hex
+    state[STATE_KEY] = {'token': token, 'inputs': tuple(float(value) for value in inputs),
+                        'result': {key: _plain(result[key]) for key in RESULT_KEYS}}
+    return token
+
+
+def load(state):
+    """Return the token, raw inputs and results saved by the session's last submit, or None."""
+    return state.get(STATE_KEY)
+
+
+class RenderStore:
+    """Render results of the sessions of this process, one entry per session."""
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_sessions=MAX_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.evicted = 0
+        # Session token -> (time last seen, renders), least recently seen first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Return the render results of a session, or None if it has none or they were evicted."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.pop(token, None)
+            if entry is None:
+                return None
+            self._entries[token] = (now, entry[1])
+            return entry[1]
+
+    def put(self, token, renders):
+        """Replace the render results of a session."""
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (now, renders)
+            self._evict(now)
+
+    def _evict(self, now):
+        while self._entries:
+            token, (last_seen, _) = next(iter(self._entries.items()))
+            if now - last_seen <= self.idle_timeout and len(self._entries) <= self.max_sessions:
+                break
+            del self._entries[token]
+            self.evicted += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+RENDERS = RenderStore()
+
+
+@metrics.register_collector
+def _session_metrics():
+    return [('session_renders', 'gauge', len(RENDERS)),
+            ('session_renders_evicted_total', 'counter', RENDERS.evicted)]
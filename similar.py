@@ -0,0 +1,214 @@
+"""
+Similar case finder for SEPERA.
+
+Counts the patients of the reference cohort with characteristics similar to a lobe, and how many of them had
+side-specific extraprostatic extension. The cohort is indexed once: rows are partitioned on the exact-match keys
+(Worst Gleason Grade Group and Perineural invasion) and sorted by age within each partition, so a query only looks at
+the candidate rows of one partition that fall within the age window.
+
+A built index can be saved as a directory of .npy files and memory-mapped read-only, so that worker processes on the
+same host share its pages instead of each building and holding a copy.
+"""
+
+import json
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from features import FEATURES
+
+# Upper bound on the number of (query, candidate) pairs compared at once by the batch queries
+BLOCK_SIZE = 1 << 20
+# Smallest age window compared on its own contiguous slice rather than as gathered pairs
+SLICE_WINDOW = 512
+
+# Tolerances of the range keys: +/- years of age, multiplicative bounds on PSA density and +/- percentage points on
+# % positive cores, % Gleason pattern 4/5 and Max % core involvement
+Tolerances = namedtuple('Tolerances', ['age', 'psa_density', 'percent'])
+TOLERANCES = Tolerances(age=5, psa_density=(0.7, 1.3), percent=10)
+
+EXACT_KEYS = ['Worst Gleason Grade Group', 'Perineural invasion']
+RANGE_KEYS = ['Age at Biopsy', 'PSA density', '% positive cores', '% Gleason pattern 4/5', 'Max % core involvement']
+OUTCOME = 'ssEPE'
+
+_EXACT = [FEATURES.index(key) for key in EXACT_KEYS]
+_RANGE = [FEATURES.index(key) for key in RANGE_KEYS]
+
+
+def _bounds(values, tolerances):
+    """Return the lower and upper bounds of every range key, one column per key in RANGE_KEYS order."""
+    values = np.asarray(values, dtype=float)
+    low_psa, high_psa = tolerances.psa_density
+    offsets = np.array([tolerances.age, 0, tolerances.percent, tolerances.percent, tolerances.percent])
+    lower = values - offsets
+    upper = values + offsets
+    lower[..., 1] = values[..., 1] * low_psa
+    upper[..., 1] = values[..., 1] * high_psa
+    return lower, upper
+
+
+class SimilarCaseIndex:
+    """Precomputed index over the reference cohort for similar case queries."""
+
+    # Arrays saved by save, besides the size of the cohort
+    ARRAYS = ['ranges', 'outcome', 'positions', 'keys', 'bounds']
+
+    def __init__(self, data):
+        exact = data[EXACT_KEYS].to_numpy(dtype=float)
+        ranges = data[RANGE_KEYS].to_numpy(dtype=float)
+        outcome = data[OUTCOME].to_numpy()
+
+        # Rows with a missing exact-match key can never match a query
+        complete = ~np.isnan(exact).any(axis=1)
+        exact, ranges, outcome = exact[complete], ranges[complete], outcome[complete]
+
+        # Sort by partition, then by age within each partition, and split at partition boundaries. The range keys are
+        # stored column-major, so that the batch queries gather each range key from contiguous memory.
+        order = np.lexsort((ranges[:, 0], exact[:, 1], exact[:, 0]))
+        exact = exact[order]
+        self.ranges = np.asfortranarray(ranges[order])
+        self.outcome = outcome[order]
+        self.positions = np.flatnonzero(complete)[order]
+        starts = np.flatnonzero(np.r_[True, (exact[1:] != exact[:-1]).any(axis=1)])
+        self.keys = exact[starts]
+        self.bounds = np.r_[starts, len(exact)]
+        self.size = len(data)
+        self._partition()
+
+    def _partition(self):
+        # Views of each partition's rows, keyed on its exact-match keys
+        self.partitions = {}
+        self.partition_positions = {}
+        for key, start, end in zip(self.keys.tolist(), self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            self.partitions[tuple(key)] = (self.ranges[start:end], self.outcome[start:end])
+            self.partition_positions[tuple(key)] = self.positions[start:end]
+
+    def save(self, directory):
+        """Save the index as a directory of .npy files, see load."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(directory / (name + '.npy'), getattr(self, name))
+        (directory / 'index.json').write_text(json.dumps({'size': self.size}))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load an index saved by save, memory-mapping its arrays (read-only) unless mmap_mode is None."""
+        directory = Path(directory)
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, np.load(directory / (name + '.npy'), mmap_mode=mmap_mode))
+        index.size = json.loads((directory / 'index.json').read_text())['size']
+        index._partition()
+        return index
+
+    def candidates(self, row, tolerances=TOLERANCES):
+        """Return the range keys and outcomes of the rows sharing row's exact-match keys and age window."""
+        row = np.asarray(row, dtype=float)
+        partition = self.partitions.get(tuple(row[_EXACT].tolist()))
+        if partition is None:
+            return np.empty((0, len(RANGE_KEYS))), np.empty(0)
+        ranges, outcome = partition
+        age = row[_RANGE[0]]
+        start = np.searchsorted(ranges[:, 0], age - tolerances.age, side='left')
+        end = np.searchsorted(ranges[:, 0], age + tolerances.age, side='right')
+        return ranges[start:end], outcome[start:end]
+
+    def query(self, row, tolerances=TOLERANCES):
+        """
+        Count the similar cases of one lobe, given as a feature row in FEATURES order.
+
+        Returns the number of similar cases with ssEPE and the total number of similar cases.
+        """
+        ranges, outcome = self.candidates(row, tolerances)
+        lower, upper = _bounds(np.asarray(row, dtype=float)[_RANGE], tolerances)
+        match = ((ranges >= lower) & (ranges <= upper)).all(axis=1)
+        return int(outcome[match].sum()), int(match.sum())
+
+    def query_batch(self, rows, tolerances=TOLERANCES):
+        """
+        Count the similar cases of many lobes at once, given as an N x 11 feature matrix in FEATURES order.
+
+        Returns two integer arrays: the number of similar cases with ssEPE and the total number of similar cases.
+        """
+        rows = np.atleast_2d(np.asarray(rows, dtype=float))
+        pos = np.zeros(len(rows), dtype=np.int64)
+        total = np.zeros(len(rows), dtype=np.int64)
+        exact = rows[:, _EXACT]
+        for key, partition in self.partitions.items():
+            members = np.flatnonzero((exact == key).all(axis=1))
+            if len(members):
+                pos[members], total[members] = _sweep(partition, rows[members][:, _RANGE], tolerances)
+        return pos, total
+
+    def leave_one_out(self, tolerances=TOLERANCES):
+        """
+        Count the similar cases of every patient of the reference cohort, excluding the patient itself.
+
+        Returns two integer arrays in the row order of the cohort the index was built from.
+        """
+        pos = np.zeros(self.size, dtype=np.int64)
+        total = np.zeros(self.size, dtype=np.int64)
+        for key, partition in self.partitions.items():
+            ranges, outcome = partition
+            partition_pos, partition_total = _sweep(partition, ranges, tolerances)
+
+            # A patient matches itself unless one of its range keys is missing or its PSA density is negative
+            lower, upper = _bounds(ranges, tolerances)
+            itself = ((ranges >= lower) & (ranges <= upper)).all(axis=1)
+            positions = self.partition_positions[key]
+            pos[positions] = partition_pos - np.where(itself, outcome, 0)
+            total[positions] = partition_total - itself
+        return pos, total
+
+
+def _sweep(partition, queries, tolerances):
+    """
+    Count the matches of many queries (range keys only) against one partition.
+
+    Each query is only compared with the candidates of its own age window, as in SimilarCaseIndex.query. Queries with
+    windows of at least SLICE_WINDOW candidates are compared with their window one at a time, on contiguous slices.
+    The (query, candidate) pairs of the other queries are gathered and compared at once, in blocks of at most
+    BLOCK_SIZE pairs, which saves the per-query overhead when windows are small.
+    """
+    ranges, outcome = partition
+    pos = np.zeros(len(queries), dtype=np.int64)
+    total = np.zeros(len(queries), dtype=np.int64)
+    columns = ranges.T
+
+    lower, upper = _bounds(queries, tolerances)
+    starts = np.searchsorted(ranges[:, 0], lower[:, 0], side='left')
+    ends = np.searchsorted(ranges[:, 0], upper[:, 0], side='right')
+    # Every candidate of a window is within the age tolerance, except when the query's age is missing: then the window
+    # holds the rows of missing age, which match nothing
+    lengths = np.where(np.isnan(queries[:, 0]), 0, np.maximum(ends - starts, 0))
+
+    for k in np.flatnonzero(lengths >= SLICE_WINDOW):
+        start, end = starts[k], ends[k]
+        candidates = ranges[start:end, 1:]
+        match = ((candidates >= lower[k, 1:]) & (candidates <= upper[k, 1:])).all(axis=1)
+        total[k] = np.count_nonzero(match)
+        pos[k] = np.count_nonzero(outcome[start:end][match])
+
+    small = np.flatnonzero(lengths < SLICE_WINDOW)
+    cumulative = np.cumsum(lengths[small])
+    i = 0
+    while i < len(small):
+        # Take the following queries while their pairs fit in BLOCK_SIZE
+        j = int(np.searchsorted(cumulative, cumulative[i] - lengths[small[i]] + BLOCK_SIZE, side='right'))
+        block = small[i:j]
+        query = np.repeat(np.arange(len(block)), lengths[block])
+        # Candidate of each pair: the start of its query's window plus its rank within the window
+        offsets = np.cumsum(lengths[block]) - lengths[block]
+        candidate = np.arange(len(query)) + np.repeat(starts[block] - offsets, lengths[block])
+
+        # Compare one range key at a time, keeping only the pairs that still match
+        for key in range(1, len(RANGE_KEYS)):
+            values = columns[key][candidate]
+            match = (values >= lower[block, key][query]) & (values <= upper[block, key][query])
+            query, candidate = query[match], candidate[match]
+        total[block] = np.bincount(query, minlength=len(block))
+        pos[block] = np.bincount(query, weights=outcome[candidate], minlength=len(block))
+        i = j
+    return pos, total
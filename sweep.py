@@ -0,0 +1,111 @@
+"""
+What-if sensitivity sweeps for SEPERA.
+
+Shows how the probability of side-specific extraprostatic extension of each lobe changes when some raw inputs of a
+patient vary over a range while the others stay fixed. The whole grid of perturbed inputs is validated with the form's
+rules, turned into lobe features with features.build_features and scored with a single model call. Grid points that
+the form would reject (e.g. a Normal site with core involvement) are left as NaN. Each curve contains the patient's own
+value of the swept input, its range shifted within the form's limits when the value falls outside it.
+"""
+
+import numpy as np
+import pandas as pd
+
+from choices import G_CHOICES
+from features import INPUT_RANGES, INPUTS, build_features, validation_errors
+from inference import predict
+
+# Default ranges of the curves shown in the web app (see around), and their axis labels
+SWEEPS = {'psa': np.arange(1.0, 41.0),
+          'p_high': np.arange(0.0, 101.0, 5)}
+LABELS = {'psa': 'PSA (ng/ml)',
+          'p_high': '% Gleason pattern 4/5 disease'}
+
+# Default axes of a site heatmap
+GRADES = [0, 1, 2, 3, 4, 5]
+INVOLVEMENT = np.arange(0.0, 101.0, 10)
+
+
+def perturb(inputs, axes):
+    """
+    Return the raw inputs of every point of a grid around one patient, along with the shape of the grid.
+
+    inputs is the patient's row of raw inputs in INPUTS order, and axes maps input names to the values they take. The
+    grid is the outer product of the axes, in their order.
+    """
+    row = np.asarray(inputs, dtype=float).reshape(-1)
+    mesh = np.meshgrid(*[np.asarray(values, dtype=float) for values in axes.values()], indexing='ij')
+    rows = np.tile(row, (mesh[0].size, 1))
+    for name, values in zip(axes, mesh):
+        rows[:, INPUTS.index(name)] = values.ravel()
+    return rows, mesh[0].shape
+
+
+def score_grid(model, rows):
+    """
+    Score both lobes of every row of raw inputs with a single model call.
+
+    Returns the left and right probabilities, NaN for rows that fail validation.
+    """
+    valid = np.equal(validation_errors(rows), None)
+    left = np.full(len(rows), np.nan)
+    right = np.full(len(rows), np.nan)
+    n = int(valid.sum())
+    if n:
+        # Grid points rarely repeat, so bypass the prediction cache
+        prob = predict(model, build_features(rows[valid]), cache=None)
+        left[valid] = prob[:n]
+        right[valid] = prob[n:]
+    return left, right
+
+
+def around(name, values, value):
+    """
+    Return the sorted values of a swept input, including the patient's value of it.
+
+    If the value falls outside the values, they are shifted to centre on it, within the form's limits of the input.
+    Unknown (-1) values leave the values as they are.
+    """
+    values = np.sort(np.asarray(values, dtype=float))
+    if value < 0:
+        return values
+    if not values[0] <= value <= values[-1]:
+        span = values[-1] - values[0]
+        start = min(max(np.floor(value - span / 2), 0.0), INPUT_RANGES[name][1] - span)
+        values = values - values[0] + start
+    return np.union1d(values, [value])
+
+
+def curves(model, inputs, sweeps=None):
+    """
+    Return one curve per swept input: a DataFrame of the left and right probabilities indexed by the input's values.
+
+    sweeps maps input names to their values (SWEEPS by default), which are adjusted to include the patient's own value
+    (see around). All curves are scored with a single model call.
+    """
+    sweeps = SWEEPS if sweeps is None else sweeps
+    row = np.asarray(inputs, dtype=float).reshape(-1)
+    sweeps = {name: around(name, values, row[INPUTS.index(name)]) for name, values in sweeps.items()}
+    grids = [perturb(inputs, {name: values})[0] for name, values in sweeps.items()]
+    left, right = score_grid(model, np.concatenate(grids))
+
+    result = {}
+    start = 0
+    for (name, values), grid in zip(sweeps.items(), grids):
+        stop = start + len(grid)
+        index = pd.Index(values, name=LABELS.get(name, name))
+        result[name] = pd.DataFrame({'Left': left[start:stop], 'Right': right[start:stop]}, index=index)
+        start = stop
+    return result
+
+
+def heatmap(model, inputs, site='base', side='left', grades=GRADES, involvement=INVOLVEMENT):
+    """
+    Return the probability of one lobe over a grid of the Gleason Grade Group and % core involvement of one of its
+    sites ('base', 'mid' or 'apex'), as a DataFrame with one row per grade and one column per involvement.
+    """
+    suffix = '_r' if side == 'right' else ''
+    rows, shape = perturb(inputs, {site + '_findings' + suffix: grades, site + '_p_inv' + suffix: involvement})
+    left, right = score_grid(model, rows)
+    prob = (right if side == 'right' else left).reshape(shape)
+    return pd.DataFrame(prob, index=[G_CHOICES[grade] for grade in grades], columns=involvement)
@@ -0,0 +1,175 @@
+"""
+Pure NumPy tree evaluator for the SEPERA model.
+
+Compiles the native XGBoost boosters written by artifacts.export_model into flat, contiguous node arrays (feature
+index, threshold, left and right child, missing-value direction, leaf value) and scores batches of feature rows with
+vectorized tree traversal, without importing XGBoost. Scores follow XGBoost: a feature value goes left when it is
+below the (float32) threshold, and missing values (NaN or the model's missing value) follow the default direction.
+
+Usage:
+    python trees.py compile model/SEPERA model/SEPERA.npz
+    python trees.py check model/SEPERA.npz --model model/SEPERA --cohort model/data.pkl
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+from features import FEATURES
+
+# Number of rows traversed at once; bounds the rows x trees matrix of node indices held in memory
+ROW_BLOCK = 64
+
+
+class CompiledModel:
+    """Flattened trees of the calibrated XGBoost ensemble, scored with NumPy only."""
+
+    ARRAYS = ['feature', 'threshold', 'left', 'right', 'default_left', 'value', 'roots', 'member_starts',
+              'base_margin', 'a', 'b']
+
+    def __init__(self, feature, threshold, left, right, default_left, value, roots, member_starts, base_margin, a, b,
+                 missing, depth):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.default_left = default_left
+        self.value = value
+        self.roots = roots
+        self.member_starts = member_starts
+        self.base_margin = base_margin
+        self.a = a
+        self.b = b
+        self.missing = missing
+        self.depth = depth
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(*[arrays[name] for name in cls.ARRAYS], float(arrays['missing']), int(arrays['depth']))
+
+    def save(self, path):
+        np.savez(path, missing=self.missing, depth=self.depth, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    def margins(self, features):
+        """Return the raw margin of every ensemble member for every row, as an N x members array."""
+        features = np.array(features, dtype=np.float32)
+        features[features == self.missing] = np.nan
+        feature = self.feature.astype(np.intp)
+        left = self.left.astype(np.intp)
+        roots = self.roots.astype(np.intp)
+
+        margins = np.empty((len(features), len(self.member_starts)))
+        for start in range(0, len(features), ROW_BLOCK):
+            block = features[start:start + ROW_BLOCK]
+            values = block.ravel()
+            offsets = (np.arange(len(block)) * block.shape[1])[:, None]
+            nodes = np.broadcast_to(roots, (len(block), len(roots))).copy()
+            for _ in range(self.depth):
+                # Right children directly follow left children, and leaves always "go left" to themselves
+                x = values[offsets + feature[nodes]]
+                go_left = (x < self.threshold[nodes]) | (np.isnan(x) & self.default_left[nodes])
+                nodes = left[nodes] + ~go_left
+            margins[start:start + len(block)] = np.add.reduceat(self.value[nodes].astype(float), self.member_starts,
+                                                                axis=1)
+        return margins + self.base_margin
+
+    def predict_proba(self, features):
+        """Score feature rows like the calibrated model: average the sigmoid-calibrated member probabilities."""
+        f = 1 / (1 + np.exp(-self.margins(features)))
+        calibrated = np.where(np.isnan(self.a), f, 1 / (1 + np.exp(self.a * f + self.b)))
+        prob = calibrated.mean(axis=1)
+        return np.column_stack([1 - prob, prob])
+
+
+def _tree_depth(left, right):
+    depth = 0
+    level = [0]
+    while level:
+        level = [child for node in level for child in (left[node], right[node]) if child != -1]
+        depth += bool(level)
+    return depth
+
+
+def compile_model(directory):
+    """Compile a directory of native JSON boosters (see artifacts.export_model) into a CompiledModel."""
+    directory = Path(directory)
+    manifest = json.loads((directory / 'calibration.json').read_text())
+
+    columns = {name: [] for name in ['feature', 'threshold', 'left', 'right', 'default_left', 'value']}
+    roots, member_starts, base_margin, a, b = [], [], [], [], []
+    n_nodes = depth = 0
+    for member in manifest['members']:
+        learner = json.loads((directory / member['booster']).read_text())['learner']
+        if learner['objective']['name'] != 'binary:logistic':
+            raise ValueError("Only binary:logistic boosters can be compiled")
+        base_score = float(learner['learner_model_param']['base_score'])
+        base_margin.append(np.log(base_score / (1 - base_score)))
+        a.append(np.nan if member['a'] is None else member['a'])
+        b.append(np.nan if member['b'] is None else member['b'])
+        member_starts.append(len(roots))
+
+        for tree in learner['gradient_booster']['model']['trees']:
+            left = np.array(tree['left_children'])
+            right = np.array(tree['right_children'])
+            leaf = left == -1
+            if (right[~leaf] != left[~leaf] + 1).any():
+                raise ValueError("Tree {} does not store its children in consecutive pairs".format(tree['id']))
+            depth = max(depth, _tree_depth(left, right))
+
+            # Leaves point to themselves, so traversal can run a fixed number of steps
+            own = np.arange(len(left)) + n_nodes
+            columns['left'].append(np.where(leaf, own, left + n_nodes))
+            columns['right'].append(np.where(leaf, own, right + n_nodes))
+            columns['feature'].append(np.where(leaf, 0, tree['split_indices']))
+            columns['threshold'].append(np.where(leaf, np.inf, tree['split_conditions']))
+            columns['default_left'].append(np.where(leaf, True, tree['default_left']))
+            columns['value'].append(np.where(leaf, tree['split_conditions'], 0))
+            roots.append(n_nodes)
+            n_nodes += len(left)
+
+    dtypes = {'feature': np.int32, 'threshold': np.float32, 'left': np.int32, 'right': np.int32,
+              'default_left': bool, 'value': np.float32}
+    arrays = {name: np.ascontiguousarray(np.concatenate(values), dtype=dtypes[name])
+              for name, values in columns.items()}
+    return CompiledModel(roots=np.array(roots, dtype=np.int32), member_starts=np.array(member_starts),
+                         base_margin=np.array(base_margin), a=np.array(a), b=np.array(b),
+                         missing=float(manifest['missing']), depth=depth, **arrays)
+
+
+def parity(compiled, model, features):
+    """Return the largest absolute difference between the compiled and the original model's probabilities."""
+    return float(np.abs(compiled.predict_proba(features)[:, 1] - model.predict_proba(features)[:, 1]).max())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile and check the NumPy tree evaluator of SEPERA.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_command = commands.add_parser('compile', help="Compile native boosters into a .npz file")
+    compile_command.add_argument('boosters', help="Directory written by artifacts.py")
+    compile_command.add_argument('output', help=".npz file to write")
+
+    check = commands.add_parser('check', help="Compare a compiled model with the original on the reference cohort")
+    check.add_argument('compiled', help=".npz file written by the compile command")
+    check.add_argument('--model', default='model/SEPERA', help="Path to the original model")
+    check.add_argument('--cohort', default='model/data.pkl', help="Path to the reference cohort")
+    check.add_argument('--tolerance', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        compile_model(args.boosters).save(args.output)
+        return
+
+    from artifacts import load_cohort, load_model
+    features = load_cohort(args.cohort)[FEATURES].to_numpy(dtype=float)
+    difference = parity(CompiledModel.load(args.compiled), load_model(args.model), features)
+    print("Largest difference over {} rows: {:.2e}".format(len(features), difference))
+    if difference > args.tolerance:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()